@@ -16,6 +16,8 @@ class Grid:
     self.shape = shape 
     self.dx = (self.corner[:] - self.origin[:])/(self.shape[:])
     self.f, self.ux, self.uy, self.uz = None, None, None, None
+    self.coords = None
+    self.fname = None
 
     # Aggregate quantities with inits
     self.nbins = 1000
@@ -38,6 +40,36 @@ class Grid:
     self.zsliceu    = np.zeros((self.shape[0], self.shape[1],3), order = 'F')
     self.dotzsliceu = np.zeros((self.shape[0], self.shape[1]), order = 'F')
 
+  def __getstate__(self):
+    # The assembled grid lives on disk; don't pickle it with the rest
+    state = self.__dict__.copy()
+    state['f'] = None
+    return state
+
+  def create_grid(self, fname, dtype):
+    """ Make an empty on-disk uniform grid (fname.f.npy) that add() fills
+        with the interpolated f of each block """
+    from numpy.lib.format import open_memmap
+    self.fname = fname
+    grid = open_memmap(self.fname + ".f.npy", mode='w+', dtype=dtype, 
+                       shape=tuple([int(n) for n in self.shape]))
+    del grid
+
+  def load_grid(self):
+    """ Open the assembled grid as f, read-only, with its coordinates along
+        each axis as coords """
+    import numpy as np
+    from numpy.lib.format import open_memmap
+    self.f = open_memmap(self.fname + ".f.npy", mode='r')
+    self.coords = [self.origin[i] + self.dx[i]*np.arange(self.f.shape[i]) for i in range(3)]
+
+  def remove_grid(self):
+    """ Close and delete the on-disk grid once it has been used """
+    from os import remove
+    self.f = None
+    remove(self.fname + ".f.npy")
+    self.fname = None
+
   def merge(self, part):
     self.f_total     += part.f_total
     self.f_m         += part.f_m
@@ -54,7 +86,9 @@ class Grid:
     self.zsliceu     += part.zsliceu
     self.dotzsliceu  += part.dotzsliceu
 
-  def add(self, pos_elm, p_elm, f_elm, ux_elm, uy_elm, uz_elm):
+  def add(self, pos_elm, p_elm, f_elm, ux_elm, uy_elm, uz_elm, root = None):
+    """ Add a block of elements; root optionally gives their integer grid
+        coordinates (3 x nelm), saving recomputing them from pos_elm """
     import numpy as np
     import numpy.linalg as lin
     import scipy.ndimage.measurements as measurements
@@ -63,11 +97,11 @@ class Grid:
 
     # First, compute aggregate quantities like total kinetic energy
     tic()
-    self.f_total  = np.add.reduce(f_elm, axis=None)
-    self.f_m      = np.add.reduce(np.minimum(f_elm*2., (1.-f_elm)*2.), axis=None)
-    self.v2       = (np.add.reduce(np.square(ux_elm), axis=None) 
-                   + np.add.reduce(np.square(uy_elm), axis=None)
-                   + np.add.reduce(np.square(uz_elm), axis=None)
+    self.f_total  = np.add.reduce(f_elm, axis=None, dtype=np.float64)
+    self.f_m      = np.add.reduce(np.minimum(f_elm*2., (1.-f_elm)*2.), axis=None, dtype=np.float64)
+    self.v2       = (np.add.reduce(np.square(ux_elm), axis=None, dtype=np.float64) 
+                   + np.add.reduce(np.square(uy_elm), axis=None, dtype=np.float64)
+                   + np.add.reduce(np.square(uz_elm), axis=None, dtype=np.float64)
                     )
     self.pdf, foo = np.histogram(f_elm.ravel(), bins=self.nbins, range=(-0.1, 1.1))
     toc('aggregate')
@@ -83,47 +117,66 @@ class Grid:
     self.zsliceu[:,:]    = 0
     self.dotzsliceu[:,:] = 0 
 
-    for i in range(pos_elm.shape[1]):
-      root = np.array((pos_elm[:,i] - self.origin)/self.dx + .5, dtype=int)
-      yoff = self.yind - root[1]
-      zoff = self.zind - root[2]
-      f_tmp  = np.reshape(f_elm[:,i], (self.order,self.order,self.order), order='F')
-      ux_tmp = np.reshape(ux_elm[:,i], (self.order,self.order,self.order), order='F')
-      uy_tmp = np.reshape(uy_elm[:,i], (self.order,self.order,self.order), order='F')
-      uz_tmp = np.reshape(uz_elm[:,i], (self.order,self.order,self.order), order='F')
-
-      self.f_xy[ root[2]:root[2]+self.order]   += np.add.reduce(f_tmp, (0,1))
-      self.ff_xy[ root[2]:root[2]+self.order]  += np.add.reduce(f_tmp*(1.-f_tmp), (0,1))
-      self.vv_xy[root[2]:root[2]+self.order,0] += np.add.reduce(ux_tmp*ux_tmp, (0,1))
-      self.vv_xy[root[2]:root[2]+self.order,1] += np.add.reduce(ux_tmp*uy_tmp, (0,1))
-      self.vv_xy[root[2]:root[2]+self.order,2] += np.add.reduce(ux_tmp*uz_tmp, (0,1))
-      self.vv_xy[root[2]:root[2]+self.order,3] += np.add.reduce(uy_tmp*uy_tmp, (0,1))
-      self.vv_xy[root[2]:root[2]+self.order,4] += np.add.reduce(uy_tmp*uz_tmp, (0,1))
-      self.vv_xy[root[2]:root[2]+self.order,5] += np.add.reduce(uz_tmp*uz_tmp, (0,1))
-
-      if yoff >= 0 and yoff < self.order:
-        p_tmp = np.reshape(p_elm[:,i], (self.order,self.order,self.order), order='F')
-
-        # y-slice of scalar field
-        self.yslice[  root[0]:root[0]+self.order, 
-                      root[2]:root[2]+self.order] = f_tmp[:,yoff,:]
-        self.yuzslice[root[0]:root[0]+self.order, 
-                      root[2]:root[2]+self.order] = uz_tmp[:,yoff,:]
-        self.yuxslice[root[0]:root[0]+self.order, 
-                      root[2]:root[2]+self.order] = ux_tmp[:,yoff,:]
-
-        self.ypslice[root[0]:root[0]+self.order, 
-                     root[2]:root[2]+self.order] = p_tmp[:,yoff,:]
-
-      if zoff >= 0 and zoff < self.order:
-        self.zslice[root[0]:root[0]+self.order, 
-                    root[1]:root[1]+self.order] = f_tmp[:,:,zoff]
-        self.zsliceu[root[0]:root[0]+self.order, 
-                     root[1]:root[1]+self.order, 0] = ux_tmp[:,:,zoff]
-        self.zsliceu[root[0]:root[0]+self.order, 
-                     root[1]:root[1]+self.order, 1] = uy_tmp[:,:,zoff]
-        self.zsliceu[root[0]:root[0]+self.order, 
-                     root[1]:root[1]+self.order, 2] = uz_tmp[:,:,zoff]
-        self.dotzsliceu[root[0]:root[0]+self.order, 
-                        root[1]:root[1]+self.order] = (uz_tmp[:,:,zoff+1] - uz_tmp[:,:,zoff-1])/(2.*self.dx[2])
-
+    # Reshape every element at once and find their grid roots
+    tic()
+    shp  = (self.order, self.order, self.order, pos_elm.shape[1])
+    f_tmp, p_tmp, ux_tmp, uy_tmp, uz_tmp = [np.reshape(a, shp, order='F') 
+                                            for a in (f_elm, p_elm, ux_elm, uy_elm, uz_elm)]
+    if root is None:
+      root = np.array((pos_elm - self.origin[:,np.newaxis])/self.dx[:,np.newaxis] + .5, dtype=int)
+    span = np.arange(self.order)
+
+    # z-profiles: reduce each element over x and y, then scatter-add by z
+    nz   = self.shape[2]
+    zidx = (span[:,np.newaxis] + root[2][np.newaxis,:]).ravel()
+    def profile(a, b):
+      red = np.einsum('ijke,ijke->ke', a, b, dtype=np.float64)
+      return np.bincount(zidx, weights=red.ravel(), minlength=nz)[:nz]
+
+    self.f_xy       += np.bincount(zidx, weights=np.einsum('ijke->ke', f_tmp, dtype=np.float64).ravel(), 
+                                   minlength=nz)[:nz]
+    self.ff_xy      += profile(f_tmp, 1.-f_tmp)
+    self.vv_xy[:,0] += profile(ux_tmp, ux_tmp)
+    self.vv_xy[:,1] += profile(ux_tmp, uy_tmp)
+    self.vv_xy[:,2] += profile(ux_tmp, uz_tmp)
+    self.vv_xy[:,3] += profile(uy_tmp, uy_tmp)
+    self.vv_xy[:,4] += profile(uy_tmp, uz_tmp)
+    self.vv_xy[:,5] += profile(uz_tmp, uz_tmp)
+    toc('profiles')
+
+    # y-slices of the elements that cross yind, as (elm, x, z) stacks
+    tic()
+    yoff = self.yind - root[1]
+    sel  = np.nonzero((yoff >= 0) & (yoff < self.order))[0]
+    ix   = root[0][sel][:,np.newaxis,np.newaxis] + span[np.newaxis,:,np.newaxis]
+    iz   = root[2][sel][:,np.newaxis,np.newaxis] + span[np.newaxis,np.newaxis,:]
+    self.yslice[  ix, iz] = f_tmp[ :, yoff[sel], :, sel]
+    self.yuzslice[ix, iz] = uz_tmp[:, yoff[sel], :, sel]
+    self.yuxslice[ix, iz] = ux_tmp[:, yoff[sel], :, sel]
+    self.ypslice[ ix, iz] = p_tmp[ :, yoff[sel], :, sel]
+
+    # z-slices of the elements that cross zind, as (elm, x, y) stacks
+    zoff = self.zind - root[2]
+    sel  = np.nonzero((zoff >= 0) & (zoff < self.order))[0]
+    ix   = root[0][sel][:,np.newaxis,np.newaxis] + span[np.newaxis,:,np.newaxis]
+    iy   = root[1][sel][:,np.newaxis,np.newaxis] + span[np.newaxis,np.newaxis,:]
+    zs   = zoff[sel]
+    self.zslice[    ix, iy]    = np.moveaxis(f_tmp[ :, :, zs, sel], -1, 0)
+    self.zsliceu[   ix, iy, 0] = np.moveaxis(ux_tmp[:, :, zs, sel], -1, 0)
+    self.zsliceu[   ix, iy, 1] = np.moveaxis(uy_tmp[:, :, zs, sel], -1, 0)
+    self.zsliceu[   ix, iy, 2] = np.moveaxis(uz_tmp[:, :, zs, sel], -1, 0)
+    self.dotzsliceu[ix, iy]    = np.moveaxis(uz_tmp[:, :, zs+1, sel] - uz_tmp[:, :, zs-1, sel], -1, 0)/(2.*self.dx[2])
+    toc('slices')
+
+    # Scatter the block into the on-disk grid.  Elements tile the grid, so
+    # blocks from different processes never write the same points.
+    if self.fname is not None:
+      tic()
+      from numpy.lib.format import open_memmap
+      grid = open_memmap(self.fname + ".f.npy", mode='r+')
+      ix = root[0][:,np.newaxis,np.newaxis,np.newaxis] + span[np.newaxis,:,np.newaxis,np.newaxis]
+      iy = root[1][:,np.newaxis,np.newaxis,np.newaxis] + span[np.newaxis,np.newaxis,:,np.newaxis]
+      iz = root[2][:,np.newaxis,np.newaxis,np.newaxis] + span[np.newaxis,np.newaxis,np.newaxis,:]
+      grid[ix, iy, iz] = np.moveaxis(f_tmp, -1, 0)
+      del grid
+      toc('grid')
@@ -19,6 +19,7 @@ def MR_init(args, params, frame):
 
   params['extent'] = list(np.array(params['extent_mesh']) - np.array(params['root_mesh']))
   params['ninterp'] = int(args.ninterp*params['order'])
+  params['upcast'] = not args.single
   if args.verbose:
     print("  Grid is ({:f}, {:f}, {:f}) [{:d}x{:d}x{:d}] with order {:d}".format(
             params['extent'][0], params['extent'][1], params['extent'][2], 
@@ -38,6 +39,10 @@ def MR_init(args, params, frame):
                 params['extent_mesh'],
                 np.array(params['shape_mesh'], dtype=int) * int(args.ninterp * params['order']),
                 boxes = args.boxes)
+  # Contours need the whole frame on a uniform grid, assembled on disk
+  if args.contour:
+    data.create_grid("{:s}-grid-{:05d}".format(args.name, frame), 
+                     np.float64 if params['upcast'] else np.float32)
 
   # return a cleaned up version of locals
   ans = locals()
@@ -46,62 +51,74 @@ def MR_init(args, params, frame):
   del ans['args']
 
   from interfaces.nek.files import NekFile
+  from interfaces.nek.catalog import load_catalog
+  # Headers from the run catalog, if this frame is in it
+  headers = load_catalog(args.name).get(str(frame))
+  if headers is not None and len(headers) < abs(int(params["io_files"])):
+    headers = None
   njob_per_file = max(1+int((args.thread-1) / abs(int(params["io_files"]))),1)
   jobs = []
   for j in range(abs(int(params["io_files"]))):
       fname = get_fname(args.name, j, frame, params)
-      input_file = NekFile(fname)
-      ans["time"] = input_file.time
-      elm_per_thread = int((input_file.nelm-1) / njob_per_file) + 1
+      if headers is not None:
+        nelm, ans["time"] = headers[j]["nelm"], headers[j]["time"]
+      else:
+        input_file = NekFile(fname)
+        nelm, ans["time"] = input_file.nelm, input_file.time
+        input_file.close()
+      elm_per_thread = int((nelm-1) / njob_per_file) + 1
       for i in range(njob_per_file):
           jobs.append([
-              (i * elm_per_thread, min((i+1)*elm_per_thread, input_file.nelm)),
+              (i * elm_per_thread, min((i+1)*elm_per_thread, nelm)),
               fname,
               params,
               args,
               ans])  
-      input_file.close()
   return jobs
 
 
-def map_(input_file, pos, nelm_to_read, params, scratch = None):
+def map_(input_file, pos, nelm_to_read, params, scratch = None, context = None):
   """ Map operations onto chunk of elements """
   import numpy as np
-  from utils.my_utils import lagrange_matrix
   from utils.my_utils import transform_field_elements
-  from utils.my_utils import transform_position_elements
+  from interfaces.nek.sem import operators
   from tictoc import tic, toc
-  from interfaces.nek.mesh import UniformMesh
+  from parallel.context import BlockContext
 
   ans = {}
   if scratch != None:
     ans = scratch
 
-  mesh = UniformMesh(input_file, params)
-  mesh.load(pos, nelm_to_read)
-  nelm, pos, vel, p, t = input_file.get_elem(nelm_to_read, pos)
+  # Positions are only needed at element corners, so skip the coordinates.
+  # Corners come from the geometry cache (--geometry) or the corners saved
+  # by the element index if there are any; otherwise reading them still
+  # reads the coordinate section's pages.
+  fields = ('u', 'v', 'w', 'p', 't')
 
-  # Let's compute the x, y, and z 1D bases
-  cart_x = np.linspace(0., params['extent'][0], num=params['ninterp'],endpoint=False)/params['shape_mesh'][0]
-  gll_x  = pos[0:params['order'],0,0] - pos[0,0,0]
+  # The mesh and block-sized buffers last for the whole job
+  if context is None:
+    context = BlockContext(input_file, params)
+  mesh = context.get_mesh()
+  mesh.load(pos, nelm_to_read, fields = fields, out = context.get_buffers(nelm_to_read, fields))
+  work = context.work
+  nshp = (params['order']**3, mesh.nelm)
 
-  cart_y = np.linspace(0., params['extent'][1], num=params['ninterp'],endpoint=False)/params['shape_mesh'][1]
-  gll_y  = pos[0:params['order']*params['order']:params['order'],1,0] - pos[0,1,0]
+  # Let's use the cached y 1D bases
+  ops = operators(params['order'], float(mesh.length[1]), params['ninterp'])
+  cart = ops['cart']; gll = ops['gll']
+  trans = ops['trans']
 
-  cart_z = np.linspace(0., params['extent'][2], num=params['ninterp'],endpoint=False)/params['shape_mesh'][2]
-  gll_z  = pos[0:params['order']**3:params['order']**2,2,0] - pos[0,2,0]
-
-  # and then just use y
-  cart = cart_y; gll = gll_y
-  trans = lagrange_matrix(gll, cart)
-
-  # pos[0,:,:] is invariant under transform, and it is all we need
-  pos_trans = pos[0,:,:]
-  #pos_trans = np.transpose(pos[0,:,:])
+  # the element corners are invariant under transform, and all we need
+  pos_trans = mesh.elm_root
 
   # transform all the fields at once
-  hunk = np.concatenate((p, t, vel[:,0,:], vel[:,1,:], vel[:,2,:]), axis=1)
-  hunk_trans = transform_field_elements(hunk, trans, cart)
+  if not 'hunk' in work or work['hunk'].shape[1] < 5*nshp[1]:
+    work['hunk']       = np.empty((nshp[0], 5*nshp[1]),             dtype=mesh.dtype, order='F')
+    work['hunk_trans'] = np.empty((params['ninterp']**3, 5*nshp[1]), dtype=mesh.dtype, order='F')
+  hunk = work['hunk'][:,:5*mesh.nelm]
+  np.concatenate([np.reshape(mesh.fld(f), nshp, order='F') for f in ('p', 't', 'u', 'v', 'w')], axis=1, out=hunk)
+  hunk_trans = transform_field_elements(hunk, trans, cart, 
+                                        out = work['hunk_trans'][:,:5*mesh.nelm], work = work)
   p_trans, t_trans, ux_trans, uy_trans, uz_trans = np.split(hunk_trans, 5, axis=1)
 
   # Save some results pre-renorm
@@ -118,13 +135,16 @@ def map_(input_file, pos, nelm_to_read, params, scratch = None):
   # Renorm t -> [0,1]
   tic()
   Tt_low = -params['atwood']/2.; Tt_high = params['atwood']/2.
-  t_trans = (t_trans - Tt_low)/(Tt_high - Tt_low)
+  t_trans -= Tt_low
+  t_trans /= (Tt_high - Tt_low)
   #t_trans = np.maximum(t_trans, -1.)
   #t_trans = np.minimum(t_trans, 2.)
   toc('renorm')
 
-  # stream the elements into the grid structure
-  ans['data'].add(pos_trans, p_trans, t_trans, ux_trans, uy_trans, uz_trans)
+  # stream the elements into the grid structure, placed by the mesh's
+  # integer element coordinates
+  ans['data'].add(pos_trans, p_trans, t_trans, ux_trans, uy_trans, uz_trans,
+                  root = mesh.elm_ijk * params['ninterp'])
 
 def reduce_(whole, part):
   """ Reduce results into a single output object (dict) """
@@ -172,7 +172,7 @@ def post_frame(ans, args, params, frame, time):
   from tictoc import tic, toc
   import numpy as np
   import matplotlib.pyplot as plt
-  from utils.my_utils import find_root
+  from utils.my_utils import find_roots
   from Grid import mixing_zone, energy_budget
   from Grid import plot_slice, plot_spectrum, plot_dist, plot_dim, plot_prof
 
@@ -193,15 +193,20 @@ def post_frame(ans, args, params, frame, time):
   if not args.contour:
     data.cont = None
   else:
+    # The frame assembled on disk by the map
+    if data.fname is not None:
+      data.load_grid()
     data.cont = np.zeros((data.shape[0], data.shape[1]))
     tic()
+    # Every column of an x-plane at once, a plane at a time off the disk
+    zs = data.coords[2]
     for i in range(data.shape[0]):
-      for j in range(data.shape[1]):
-        print(i,j)
-        data.cont[i,j] = find_root(data.x[i,j,:,2], data.f[i,j,:], desired_resolution = 1.e-15)
+      data.cont[i,:] = find_roots(zs, data.f[i,:,:])
+    if data.fname is not None:
+      data.remove_grid()
     if frame == 1:
-      modes_x = np.fft.fftfreq(data.shape[0], data.x[1,0,0,0] - data.x[0,0,0,0]) 
-      modes_y = np.fft.rfftfreq(data.shape[1], data.x[0,1,0,1] - data.x[0,0,0,1]) 
+      modes_x = np.fft.fftfreq(data.shape[0], data.coords[0][1] - data.coords[0][0]) 
+      modes_y = np.fft.rfftfreq(data.shape[1], data.coords[1][1] - data.coords[1][0]) 
       modes = np.zeros((modes_x.size, modes_y.size))
       for i in range(modes_x.size):
         for j in range(modes_y.size):
@@ -19,6 +19,7 @@ def MR_init(args, params, frame):
 
   params['extent'] = list(np.array(params['extent_mesh']) - np.array(params['root_mesh']))
   params['ninterp'] = int(args.ninterp*params['order'])
+  params['upcast'] = not args.single
   if args.verbose:
     print("  Grid is ({:f}, {:f}, {:f}) [{:d}x{:d}x{:d}] with order {:d}".format(
             params['extent'][0], params['extent'][1], params['extent'][2], 
@@ -35,29 +36,38 @@ def MR_init(args, params, frame):
   # return a cleaned up version of locals
 
   from interfaces.nek.files import NekFile
+  from interfaces.nek.catalog import load_catalog
+  # Headers from the run catalog, if this frame is in it
+  headers = load_catalog(args.name).get(str(frame))
+  if headers is not None and len(headers) < abs(int(params["io_files"])):
+    headers = None
   njob_per_file = max(1+int((args.thread-1) / abs(int(params["io_files"]))),1)
   jobs = []
   from copy import deepcopy
   for j in range(abs(int(params["io_files"]))):
       fname = get_fname(args.name, j, frame, params)
-      input_file = NekFile(fname)
-      elm_per_thread = int((input_file.nelm-1) / njob_per_file) + 1
+      if headers is not None:
+        nelm = headers[j]["nelm"]
+      else:
+        input_file = NekFile(fname)
+        nelm = input_file.nelm
+        input_file.close()
+      elm_per_thread = int((nelm-1) / njob_per_file) + 1
       for i in range(njob_per_file):
           jobs.append([
-              (i * elm_per_thread, min((i+1)*elm_per_thread, input_file.nelm)),
+              (i * elm_per_thread, min((i+1)*elm_per_thread, nelm)),
               fname,
               params,
               args,
               deepcopy(ans)])  
-      input_file.close()
   return jobs
 
 
-def map_(input_file, pos, nelm_to_read, params, scratch = None):
+def map_(input_file, pos, nelm_to_read, params, scratch = None, context = None):
   """ Map operations onto chunk of elements """
   import numpy as np
   from tictoc import tic, toc
-  from interfaces.nek.mesh import UniformMesh
+  from parallel.context import BlockContext
 
   ans = {}
   if scratch != None:
@@ -66,8 +76,11 @@ def map_(input_file, pos, nelm_to_read, params, scratch = None):
   a = Struct(ans)
   p = Struct(params)
 
-  mesh = UniformMesh(input_file, params)
-  mesh.load(pos, nelm_to_read)
+  # The mesh and block-sized buffers last for the whole job
+  if context is None:
+    context = BlockContext(input_file, params)
+  mesh = context.get_mesh()
+  mesh.load(pos, nelm_to_read, out = context.get_buffers(nelm_to_read))
 
   # We need to union these sets
   a.red_uin = ['red_max', 'red_min', 'red_sum', 'slices']
@@ -79,51 +92,64 @@ def map_(input_file, pos, nelm_to_read, params, scratch = None):
                mesh.origin[2] + mesh.extent[2]/2.
                )
 
-  # Min and max values, mostly for stability
-  max_speed = np.sqrt(mesh.max(
-                np.square(mesh.fld('u')) 
-              + np.square(mesh.fld('v')) 
-              + np.square(mesh.fld('w'))
-                              ))
+  # Expressions passed to int, slice and batch are evaluated a chunk of
+  # elements at a time, so they never take a whole block of memory, and
+  # those batched together share their subexpressions
+
+  # Total energy, its components projected onto z, and the peak speed
+  squares = ['u*u', 'v*v', 'w*w']
+  kinetic, (a.u2_proj_z, a.v2_proj_z, a.w2_proj_z), speed2 = mesh.batch([
+    ('int',   squares),
+    ('slice', squares, intercept, (0,1), np.add),
+    ('max',   'u*u + v*v + w*w')])
 
+  # Min and max values, mostly for stability
   a.TMax   = float(mesh.max(mesh.fld('t')))
   a.red_max.append('TMax')
   a.TMin   = float(mesh.min(mesh.fld('t')))
   a.red_min.append('TMin')
-  a.UAbs   = float( max_speed)
+  a.UAbs   = float(np.sqrt(speed2))
   a.red_max.append('UAbs')
   a.time   = input_file.time
   a.red_max.append('time')
   a.dx_max = float(np.max(mesh.gll[1:] - mesh.gll[:-1]))
   a.red_max.append('dx_max')
 
-  # Total energy 
-  a.Kinetic_x = mesh.int(np.square(mesh.fld('u')))/2.
-  a.Kinetic_y = mesh.int(np.square(mesh.fld('v')))/2. 
-  a.Kinetic_z = mesh.int(np.square(mesh.fld('w')))/2.
+  a.Kinetic_x, a.Kinetic_y, a.Kinetic_z = [e/2. for e in kinetic]
   a.red_sum += ['Kinetic_x', 'Kinetic_y', 'Kinetic_z']
  
   a.Kinetic = a.Kinetic_x + a.Kinetic_y + a.Kinetic_z
   a.red_sum.append('Kinetic')
 
-  a.Potential = p.g * mesh.int(
-                   mesh.fld('t') * mesh.fld('z')
-                                        )
+  a.Potential = p.g * mesh.int('t*z')
   a.red_sum.append('Potential')
 
-   
+  # Every term with a derivative goes in one batch, so each chunk takes the
+  # velocity gradient once.  Dissipation is linear in the viscosity, so
+  # scale after reducing.
+  vort_z = 'dx(v,0) - dx(u,1)'
+  diss = ('2*(dx(u,0)**2 + dx(v,1)**2 + dx(w,2)**2)'
+          ' + (dx(v,0) + dx(u,1))**2 + (dx(w,1) + dx(v,2))**2 + (dx(u,2) + dx(w,0))**2')
+  (a.vorticity_xy, a.vorticity_proj_z, a.vorticity_yz,
+   (a.du2_proj_z, a.dv2_proj_z, a.dw2_proj_z),
+   dissipated, d_xy, d_yz) = mesh.batch([
+    ('slice', vort_z, intercept, (2,)),
+    ('slice', '(' + vort_z + ')**2', intercept, (0,1), np.add),
+    ('slice', 'dx(w,1) - dx(v,2)', intercept, (0,)),
+    ('slice', ['dx(u,0)**2', 'dx(v,1)**2', 'dx(w,2)**2'], intercept, (0,1), np.add),
+    ('int',   diss),
+    ('slice', diss, intercept, (2,)),
+    ('slice', diss, intercept, (0,))])
+  a.Dissipated = p.viscosity * dissipated * p.io_time
+  a.red_sum.append('Dissipated')
+  a.d_xy = p.viscosity * d_xy
+  a.d_yz = p.viscosity * d_yz
+
   # Take slices
-  omegaz = mesh.dx('v',0) - mesh.dx('u',1)
-  a.vorticity_xy = mesh.slice(omegaz,
-                              intercept, (2,))
-  a.vorticity_proj_z = mesh.slice(np.square(omegaz), intercept, (0,1), np.add)
-  a.vorticity_yz = mesh.slice(mesh.dx('w',1) - mesh.dx('v',2),
-                              intercept, (0,))
   a.t_xy = mesh.slice(mesh.fld('t'), intercept, (2,))
   a.t_yz = mesh.slice(mesh.fld('t'), intercept, (0,))
   a.t_proj_z  = mesh.slice(mesh.fld('t'), intercept, (0,1), np.add)
-  a.t_abs_proj_z = mesh.slice(np.abs(mesh.fld('t')), intercept, (0,1), np.add)
-  a.t_sq_proj_z  = mesh.slice(np.square(mesh.fld('t')), intercept, (0,1), np.add)
+  a.t_abs_proj_z, a.t_sq_proj_z = mesh.slice(['abs(t)', 't*t'], intercept, (0,1), np.add)
   a.u_xy = mesh.slice(mesh.fld('u'), intercept, (2,))
   a.v_xy = mesh.slice(mesh.fld('v'), intercept, (2,))
   a.w_xy = mesh.slice(mesh.fld('w'), intercept, (2,))
@@ -133,36 +159,10 @@ def map_(input_file, pos, nelm_to_read, params, scratch = None):
   a.slices = ['vorticity_xy', 'vorticity_yz', 'vorticity_proj_z', 
               't_xy', 't_yz', 't_proj_z', 't_abs_proj_z', 't_sq_proj_z',
               'p_xy', 'p_yz', 'u_xy', 'v_xy', 'w_xy', 'w_yz']
-
-  u2 = np.square(mesh.fld('u'))
-  v2 = np.square(mesh.fld('v'))
-  w2 = np.square(mesh.fld('w'))
-  du2 = np.square(mesh.dx('u',0))
-  dv2 = np.square(mesh.dx('v',1))
-  dw2 = np.square(mesh.dx('w',2))
-  a.u2_proj_z = mesh.slice(u2, intercept, (0,1), np.add)
-  a.v2_proj_z = mesh.slice(v2, intercept, (0,1), np.add)
-  a.w2_proj_z = mesh.slice(w2, intercept, (0,1), np.add)
-  a.du2_proj_z = mesh.slice(du2, intercept, (0,1), np.add)
-  a.dv2_proj_z = mesh.slice(dv2, intercept, (0,1), np.add)
-  a.dw2_proj_z = mesh.slice(dw2, intercept, (0,1), np.add)
   a.slices += [ 'u2_proj_z',  'v2_proj_z',  'w2_proj_z']
   a.slices += ['du2_proj_z', 'dv2_proj_z', 'dw2_proj_z']
-
-  diss = p.viscosity * (
-        2. * (du2+dv2+dw2) 
-      +  np.square(mesh.dx('v',0) + mesh.dx('u',1))  
-      +  np.square(mesh.dx('w',1) + mesh.dx('v',2))  
-      +  np.square(mesh.dx('u',2) + mesh.dx('w',0))
-                       )
-  a.Dissipated = mesh.int(diss) * p.io_time
-  a.red_sum.append('Dissipated')
-  a.d_xy = mesh.slice(diss, intercept, (2,))
-  a.d_yz = mesh.slice(diss, intercept, (0,))
   a.slices += ['d_xy', 'd_yz']
 
-
-
   a.red_sum += a.slices
   return ans
 
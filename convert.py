@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+"""
+Convert a run's field files to compressed chunks (interfaces.nek.chunked),
+which later passes read in place of the originals
+"""
+
+# get arguments
+from ui import command_line_ui
+args = command_line_ui()
+
+# load params from genrun.py input dictionary
+import json
+with open("{:s}.json".format(args.name), 'r') as f:
+  params = json.load(f)
+
+from importlib import import_module
+from interfaces.nek.files import NekFile
+from interfaces.nek.chunked import convert, chunked_name, quantized_name
+MR = import_module(args.mapreduce)
+
+# Error bounds make a lossy copy, kept apart from the lossless one
+bounds = dict([(b.split('=')[0], float(b.split('=')[1])) for b in args.bounds])
+
+for frame in range(args.frame, args.frame_end+1):
+  for proc in range(abs(int(params["io_files"]))):
+    fname = MR.get_fname(args.name, proc, frame, params)
+    with NekFile(fname, mmap = args.mmap) as input_file:
+      # Frames without coordinates share those of the first frame
+      input_file.geometry_from()
+      # Chunks line up with the blocks the map will ask for
+      if len(bounds) > 0:
+        dirname = quantized_name(fname)
+      else:
+        dirname = chunked_name(fname)
+      convert(input_file, dirname, block = args.block, bounds = bounds)
+    if args.verbose:
+      print("Converted {:s}".format(fname))
+    if len(bounds) > 0:
+      with open("{:s}/meta.json".format(dirname), 'r') as f:
+        errors = json.load(f)["errors"]
+      for name in sorted(errors):
+        print("  {:s} error: max {:e} (bound {:e}), RMS {:e}".format(
+              name, errors[name][0], bounds[name], errors[name][1]))
@@ -10,10 +10,57 @@ class AbstractFileReader(metaclass=ABCMeta):
   def close(self):
     pass
 
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+    return False
+
   @abstractmethod
   def get_elem(self, num, pos):
     pass
 
+  @abstractmethod
+  def get_root(self, num, pos):
+    pass
+
+  def views(self, upcast):
+    """Whether get_elem(..., upcast=upcast) returns views of the file
+    itself, so reading into out= buffers would only add a copy."""
+    return False
+
+  def fill(self, raw, name, upcast, out):
+    """Deliver a field as read: into out[name] if given, else upcast or not."""
+    import numpy as np
+    if out is not None and name in out:
+      dest = out[name][...,:raw.shape[-1]]
+      if not np.may_share_memory(dest, raw):
+        np.copyto(dest, raw)
+      return dest
+    if upcast:
+      return raw.astype(np.float64)
+    return raw
+
+  def buffers(self, num, upcast = True, fields = ('x', 'u', 'p', 't')):
+    """Arrays for get_elem(..., out=) to read num elements of fields into.
+
+    They are float64 if upcast, otherwise the file's dtype in native order.
+    """
+    import numpy as np
+    if upcast:
+      dtype = np.dtype(np.float64)
+    else:
+      dtype = np.dtype(self.ty).newbyteorder('=')
+    n3 = self.norder**3
+    out = {}
+    for name in fields:
+      if name in ('x', 'u'):
+        out[name] = np.empty((n3, 3, num), dtype=dtype, order='F')
+      else:
+        out[name] = np.empty((n3,    num), dtype=dtype, order='F')
+    return out
+
 class AbstractMesh(metaclass=ABCMeta):
   @abstractmethod
   def __init__(self, reader):
@@ -0,0 +1,66 @@
+"""
+Catalog of the header of every file in a run, so frames can be scheduled
+without opening their files
+"""
+
+def catalog_name(name):
+  """Path of the catalog of run name."""
+  return "{:s}-catalog.json".format(name)
+
+def read_header(fname):
+  """Number of elements and time of a field file, from one read of its header."""
+  with open(fname, 'rb') as f:
+    htoks = str(f.read(132)).split()
+  return int(htoks[5]), float(htoks[7])
+
+def load_catalog(name):
+  """Catalog of run name, keyed by frame (as a string) then proc."""
+  import json
+  from os.path import exists
+  if not exists(catalog_name(name)):
+    return {}
+  with open(catalog_name(name), 'r') as f:
+    return json.load(f)
+
+def update_catalog(name, params, frames, get_fname):
+  """Add frames that are not yet in the catalog of run name, and save it.
+
+  Only the new frames' headers are read, along with those of frames whose
+  files were rewritten since they were cataloged (their size and mtime no
+  longer match); frames whose files are missing are left out, so they are
+  picked up by a later update.
+  """
+  import json
+  from os import getpid, replace
+  from interfaces.nek.chunked import source_stamp
+  cat = load_catalog(name)
+  changed = False
+  for frame in frames:
+    try:
+      fnames = [get_fname(name, proc, frame, params) 
+                for proc in range(abs(int(params["io_files"])))]
+      stamps = [source_stamp(fname) for fname in fnames]
+      if [h.get("source") for h in cat.get(str(frame), [])] == stamps:
+        continue
+      headers = []
+      for fname, stamp in zip(fnames, stamps):
+        nelm, time = read_header(fname)
+        headers.append({"nelm": nelm, "time": time, "source": stamp})
+      cat[str(frame)] = headers
+    except OSError:
+      if cat.pop(str(frame), None) is None:
+        continue
+    changed = True
+  if not changed:
+    return cat
+
+  # Write then rename, so a concurrent reader never sees a partial catalog
+  tname = "{:s}.{:d}".format(catalog_name(name), getpid())
+  try:
+    with open(tname, 'w') as f:
+      json.dump(cat, f)
+    replace(tname, catalog_name(name))
+  except OSError:
+    # Read-only run directories still get the catalog in memory
+    pass
+  return cat
@@ -0,0 +1,286 @@
+"""
+Compressed, chunked copies of Nek field files, for runs analyzed many times
+"""
+
+from interfaces.abstract import AbstractFileReader
+
+def chunked_name(fname):
+  """Directory holding the chunked copy of field file fname."""
+  return "{:s}.chunks".format(fname)
+
+def quantized_name(fname):
+  """Directory holding the lossy, quantized copy of field file fname."""
+  return "{:s}.q".format(fname)
+
+def source_stamp(fname):
+  """Size and modification time (ns) of field file fname."""
+  from os import stat
+  st = stat(fname)
+  return [st.st_size, st.st_mtime_ns]
+
+def is_current(dirname, fname):
+  """Whether dirname holds a copy made by convert() from fname as it is now.
+
+  Copies of a file that has since been rewritten, or that don't record
+  their source, are stale and shouldn't be read in its place.
+  """
+  import json
+  from os.path import join, exists
+  if not exists(join(dirname, "meta.json")):
+    return False
+  with open(join(dirname, "meta.json"), 'r') as f:
+    source = json.load(f).get("source")
+  try:
+    return source == source_stamp(fname)
+  except OSError:
+    return False
+
+def quantize(f, bound, dtype):
+  """Quantize f (N^3 x ncomp x nelm) to within bound of its values.
+
+  Each component of each element gets its own grid, from its minimum in
+  steps spanning its range, with 8-bit codes if that meets the bound for
+  the whole block and 16-bit codes otherwise.  The bound is checked on the
+  values dequantize() gives in dtype, the precision the reader returns.
+  Returns the codes, the float32 offsets and steps (ncomp x nelm) that
+  dequantize() needs and the errors, or None if neither meets the bound.
+  """
+  import numpy as np
+  f = np.asarray(f, dtype=np.float64)
+  lo = np.min(f, axis=0)
+  hi = np.max(f, axis=0)
+  for ctype in (np.uint8, np.uint16):
+    step = ((hi - lo) / np.iinfo(ctype).max).astype(np.float32)
+    lo32 = lo.astype(np.float32)
+    codes = np.rint((f - lo32) / np.where(step > 0, step, 1.))
+    codes = np.clip(codes, 0, np.iinfo(ctype).max).astype(ctype)
+    err = np.abs(dequantize(codes, lo32, step, dtype).astype(np.float64) - f)
+    if np.all(err <= bound):
+      return codes, lo32, step, err
+  return None
+
+def dequantize(codes, lo, step, dtype):
+  """Values of codes on the grids given by lo and step, as dtype."""
+  f = codes.astype(dtype)
+  f *= step
+  f += lo
+  return f
+
+def get_codec(name, typesize = 4):
+  """Compress and decompress functions for codec name (blosc, lz4 or zlib)."""
+  if name == 'blosc':
+    import blosc
+    return (lambda b: blosc.compress(b, typesize=typesize)), blosc.decompress
+  if name == 'lz4':
+    import lz4.frame
+    return lz4.frame.compress, lz4.frame.decompress
+  import zlib
+  return (lambda b: zlib.compress(b, 1)), zlib.decompress
+
+def best_codec():
+  """The fastest codec that is installed; zlib is always there."""
+  from importlib import import_module
+  for name, module in (('blosc', 'blosc'), ('lz4', 'lz4.frame')):
+    try:
+      import_module(module)
+      return name
+    except ImportError:
+      pass
+  return 'zlib'
+
+def convert(reader, dirname, block = 65536, codec = None, bounds = None):
+  """Write the fields of reader to dirname, one file per field.
+
+  Each field is stored as compressed chunks of block elements, in the
+  reader's precision, with the chunk offsets and the element corners kept
+  alongside so the copy can be read without the original.
+
+  Fields named in the dict bounds are quantized to within that absolute
+  error instead (see quantize), or stored exactly for blocks where that
+  can't be done; the maximum and RMS errors achieved are recorded in the
+  metadata as "errors".
+  """
+  import json
+  import numpy as np
+  from os import makedirs
+  from os.path import join
+  if codec is None:
+    codec = best_codec()
+  compress = get_codec(codec, reader.word_size)[0]
+  makedirs(dirname, exist_ok = True)
+
+  meta = {"norder": reader.norder, "nelm": reader.nelm, "time": reader.time,
+          "block": block, "codec": codec, "fields": {}, "offsets": {},
+          "bounds": {}, "bits": {}, "errors": {},
+          "source": source_stamp(reader.fname)}
+  if bounds is None:
+    bounds = {}
+  sumsq = {}
+  files = {}
+  for pos in range(0, reader.nelm, block):
+    n, x, u, p, t = reader.get_elem(block, pos, upcast = False)
+    for name, f in (('x', x), ('u', u), ('p', p), ('t', t)):
+      if f is None:
+        continue
+      if not name in files:
+        files[name] = open(join(dirname, "{:s}.bin".format(name)), 'wb')
+        meta["fields"][name] = 3 if f.ndim == 3 else 1
+        meta["offsets"][name] = [0]
+        meta["dtype"] = np.dtype(f.dtype).newbyteorder('=').str
+      quantized = None
+      if name in bounds:
+        if not name in meta["bits"]:
+          meta["bounds"][name], meta["bits"][name] = bounds[name], []
+          meta["errors"][name], sumsq[name] = [0., 0.], 0.
+        f = np.reshape(f, (f.shape[0], -1, f.shape[-1]), order='F')
+        quantized = quantize(f, bounds[name], meta["dtype"])
+      if name in bounds and quantized is not None:
+        codes, lo, step, err = quantized
+        meta["errors"][name][0] = max(meta["errors"][name][0], float(np.max(err)))
+        sumsq[name] += float(np.sum(np.square(err)))
+        meta["bits"][name].append(8*codes.itemsize)
+        raw = lo.tobytes(order='F') + step.tobytes(order='F') + codes.tobytes(order='F')
+      else:
+        # Blocks 16-bit codes can't bring within the bound are kept exactly
+        if name in bounds:
+          meta["bits"][name].append(0)
+        raw = np.asfortranarray(f, dtype=meta["dtype"]).tobytes(order='F')
+      files[name].write(compress(raw))
+      meta["offsets"][name].append(files[name].tell())
+  for name in files:
+    files[name].close()
+  for name in sumsq:
+    # Normalized like validate.py
+    meta["errors"][name][1] = float(np.sqrt(sumsq[name] / reader.ntot))
+
+  np.save(join(dirname, "root.npy"), reader.get_root(reader.nelm, 0)[1])
+  with open(join(dirname, "meta.json"), 'w') as f:
+    json.dump(meta, f)
+  return
+
+class ChunkedFile(AbstractFileReader):
+  """Read the chunked copy of a field file written by convert().
+
+  Chunks are decompressed (and dequantized, for lossy copies) whole; the
+  last chunk of each field is kept, so blocks aligned with the chunks
+  decode each chunk once.
+  """
+  def __init__(self, dirname):
+    import json
+    import numpy as np
+    from os.path import join
+    self.fname = dirname
+    with open(join(dirname, "meta.json"), 'r') as f:
+      self.meta = json.load(f)
+    self.norder = self.meta["norder"]
+    self.nelm   = self.meta["nelm"]
+    self.time   = self.meta["time"]
+    self.block  = self.meta["block"]
+    self.ty     = self.meta["dtype"]
+    self.word_size = np.dtype(self.ty).itemsize
+    self.ntot   = self.nelm * self.norder**3
+    self.sections = self.meta["fields"]
+    self.decompress = get_codec(self.meta["codec"])[1]
+    self.root   = np.load(join(dirname, "root.npy"))
+    self.files  = {}
+    self.last   = {}
+    self.index  = None
+    self.current_elm = 0
+    return
+
+  def close(self):
+    """Close the field files and drop the cached chunks."""
+    for name in self.files:
+      self.files[name].close()
+    self.files = {}
+    self.last = {}
+    return
+
+  def chunk(self, name, ichunk):
+    """Decompressed chunk ichunk of field name, shaped (N^3,ncomp,nchunk)."""
+    import numpy as np
+    from os import pread
+    from os.path import join
+    if name in self.last and self.last[name][0] == ichunk:
+      return self.last[name][1]
+    if not name in self.files:
+      self.files[name] = open(join(self.fname, "{:s}.bin".format(name)), 'rb')
+    start, end = self.meta["offsets"][name][ichunk:ichunk+2]
+    raw = self.decompress(pread(self.files[name].fileno(), end - start, start))
+    nchunk = min(self.block, self.nelm - ichunk*self.block)
+    shape = (self.norder**3, self.sections[name], nchunk)
+    if self.meta.get("bits", {}).get(name, [0]*(ichunk+1))[ichunk] > 0:
+      # Offsets and steps, then the codes
+      nscale = self.sections[name] * nchunk
+      lo   = np.frombuffer(raw, dtype=np.float32, count=nscale)
+      step = np.frombuffer(raw, dtype=np.float32, count=nscale, offset=4*nscale)
+      codes = np.frombuffer(raw, dtype='u{:d}'.format(self.meta["bits"][name][ichunk] // 8), 
+                            offset=8*nscale)
+      arr = dequantize(np.reshape(codes, shape, order='F'), 
+                       np.reshape(lo,   shape[1:], order='F'),
+                       np.reshape(step, shape[1:], order='F'), self.ty)
+    else:
+      arr = np.reshape(np.frombuffer(raw, dtype=self.ty), shape, order='F')
+    self.last[name] = (ichunk, arr)
+    return arr
+
+  def get_elem(self, num = 1024, pos = -1, upcast = True, fields = ('x', 'u', 'p', 't'), out = None):
+    """Read sequential elements, or those listed in pos; see NekFile.get_elem."""
+    import numpy as np
+    if np.ndim(pos) == 0:
+      if pos < 0:
+        pos = self.current_elm
+      numl = min(num, self.nelm - pos)
+      if numl <= 0:
+        return 0, None, None, None, None
+      self.current_elm = pos + numl
+      idx = None
+    else:
+      idx = np.asarray(pos, dtype=int)
+      numl = idx.size
+
+    res = {}
+    for name in fields:
+      if not name in self.sections:
+        continue
+      if idx is None:
+        # Slices of each chunk the block overlaps
+        pieces = []
+        for ichunk in range(pos // self.block, (pos + numl - 1) // self.block + 1):
+          lo = max(pos, ichunk*self.block) - ichunk*self.block
+          hi = min(pos + numl, (ichunk+1)*self.block) - ichunk*self.block
+          pieces.append(self.chunk(name, ichunk)[:,:,lo:hi])
+        raw = pieces[0] if len(pieces) == 1 else np.concatenate(pieces, axis=2)
+      else:
+        # Gather from each chunk the listed elements fall in
+        raw = np.empty((self.norder**3, self.sections[name], numl), dtype=self.ty, order='F')
+        ichunks = idx // self.block
+        for ichunk in np.unique(ichunks):
+          sel = ichunks == ichunk
+          raw[:,:,sel] = self.chunk(name, ichunk)[:,:,idx[sel] - ichunk*self.block]
+      if self.sections[name] == 1:
+        raw = raw[:,0,:]
+      res[name] = self.fill(raw, name, upcast, out)
+
+    return numl, res.get('x'), res.get('u'), res.get('p'), res.get('t')
+
+  def get_root(self, num = 1024, pos = -1):
+    """Element corners, from the stored index rather than the coordinates."""
+    import numpy as np
+    if np.ndim(pos) > 0:
+      idx = np.asarray(pos, dtype=int)
+      return idx.size, self.root[:,idx]
+    if pos < 0:
+      pos = self.current_elm
+    numl = min(num, self.nelm - pos)
+    if numl < 0:
+      return 0, None
+    return numl, self.root[:,pos:pos+numl]
+
+  def get_index(self, origin, length):
+    """Integer grid coordinates (3 x nelm) of each element's corner."""
+    import numpy as np
+    if self.index is None:
+      self.index = np.array(np.rint((self.root - np.reshape(origin, (3,1)))
+                                    / np.reshape(length, (3,1))), dtype=np.int32)
+    return self.index
@@ -1,17 +1,34 @@
 
 from interfaces.abstract import AbstractFileReader
 
+def geometry_name(fname, params):
+  """Name of the geometry cache shared by every frame of fname's proc."""
+  from os.path import splitext
+  shape = params['shape_mesh']
+  return "{:s}.geom-{:d}x{:d}x{:d}-{:d}".format(
+           splitext(fname)[0], shape[0], shape[1], shape[2], abs(int(params['io_files'])))
+
 class NekFile(AbstractFileReader):
-  def __init__(self, fname, base = None):
+  def __init__(self, fname, base = None, mmap = False):
     # Do we have another file to base this off of?
     if base != None:
       self.init2(base, fname)
       return
 
+    # Read through a memory map of the whole file?
+    self.mmap = mmap
+    self.data = None
+    self.index = None
+    self.corners = None
+    self.geom_root = None
+    self.geom_x = None
+    self.geom_file = None
+    self.stage = None
+
     import struct
     self.fname = fname
-    self.x_file = open(fname, 'rb')
-    self.header = self.x_file.read(132)
+    self.file = open(fname, 'rb')
+    self.header = self.file.read(132)
     htoks = str(self.header).split()
     self.word_size = int(htoks[1])
     self.norder = int(htoks[2])
@@ -27,8 +44,14 @@ class NekFile(AbstractFileReader):
     #''' Assume isotropic elements '''
     self.ntot = self.nelm * self.norder**3
 
+    # Which fields the file holds, from the variable list (e.g. XUPT or UPT)
+    rdcode = 'XUPT'
+    if len(htoks) > 11 and htoks[11].strip("'").isalnum():
+      rdcode = htoks[11].strip("'")
+    self.sections, self.nword = self.layout(rdcode)
+
     #''' Check the test float '''
-    self.test = self.x_file.read(4)
+    self.test = self.file.read(4)
     self.test_tuple = struct.unpack('f', self.test)
     byteswap = abs(self.test_tuple[0] - 6.543210029) > 0.00001
     if byteswap:
@@ -37,150 +60,430 @@ class NekFile(AbstractFileReader):
       self.ty = 'f{:1d}'.format(self.word_size)
     self.bformat = None
 
-    # Test opening the file
+    # Keep the handle open for reads until close()
     self.current_elm = 0
-    self.u_file = open(fname, 'rb')
-    self.p_file = open(fname, 'rb')
-    self.t_file = open(fname, 'rb')
-    self.seek(0)
-    # Then close it
-    self.close()
 
   def init2(self, base, fname):
     # copy state and write header
     self.fname = fname
-    self.x_file = open(fname, 'wb')
+    self.file = open(fname, 'wb')
     self.header = base.header
-    self.x_file.write(self.header)
+    self.file.write(self.header)
     self.nelm = base.nelm
     self.norder = base.norder
     self.time = base.time
     self.padded = base.padded
     self.ntot = base.ntot
+    self.sections = base.sections
+    self.nword = base.nword
     self.test = base.test
-    self.x_file.write(self.test)
+    self.file.write(self.test)
     self.ty = base.ty
     self.bformat = base.bformat
     self.word_size = base.word_size
+    self.mmap = False
+    self.data = None
+    self.index = None
+    self.corners = None
+    self.geom_root = None
+    self.geom_x = None
+    self.geom_file = None
+    self.stage = None
+
+    # Size the file so elements can be written in any order
+    self.file.truncate(self.offset() + self.nword*self.word_size)
 
-    # Test opening the file
+    # Writes reopen the file without truncating it
     self.current_elm = 0
-    self.u_file = open(fname, 'wb')
-    self.p_file = open(fname, 'wb')
-    self.t_file = open(fname, 'wb')
-    self.seek(0)
-    # Then close it
     self.close()
 
+  def layout(self, rdcode):
+    """Offset (in words past offset()) and number of components of each
+    field named in the header's variable list.
+
+    Returns the table, keyed by 'x', 'u', 'p', 't' and 's1', 's2', ... for
+    passive scalars, and the total number of words of field data.
+    """
+    sections = {}
+    nword = 0
+    i = 0
+    while i < len(rdcode):
+      if rdcode[i] in 'XU':
+        sections[rdcode[i].lower()] = (nword, 3)
+        nword += 3*self.ntot
+      elif rdcode[i] in 'PT':
+        sections[rdcode[i].lower()] = (nword, 1)
+        nword += self.ntot
+      elif rdcode[i] == 'S':
+        for j in range(int(rdcode[i+1:i+3])):
+          sections['s{:d}'.format(j+1)] = (nword, 1)
+          nword += self.ntot
+        i += 2
+      i += 1
+    return sections, nword
+
+  def section(self, data, name):
+    """View of field name in the mapped data, shaped (N^3,ncomp,nelm)."""
+    import numpy as np
+    start, ncomp = self.sections[name]
+    return np.reshape(data[start:start + ncomp*self.ntot], 
+                      (self.norder**3, ncomp, self.nelm), order='F')
+
+  def geometry_from(self, fname = None):
+    """Read coordinates from another file of the same mesh and proc, by
+    default its first frame, if this frame was written without them."""
+    from os.path import splitext
+    if 'x' in self.sections:
+      return
+    if fname is None:
+      fname = splitext(self.fname)[0] + ".f00001"
+    self.geom_file = NekFile(fname, mmap = self.mmap)
+    return
+
+  def geometry(self, num, pos):
+    """Coordinates of num elements from pos (or of the elements listed in
+    pos), from the geometry cache or the geometry file."""
+    import numpy as np
+    if self.geom_x is not None:
+      if np.ndim(pos) > 0:
+        return self.geom_x[:,:,pos]
+      return self.geom_x[:,:,pos:pos+num]
+    if self.geom_file is None:
+      raise ValueError("{:s} has no coordinates; see geometry_from".format(self.fname))
+    return self.geom_file.get_elem(num, pos, upcast = False, fields = ('x',))[1]
+
   def close(self):
     """Close file pointers and point handles to None."""
-    if self.x_file != None:
-      self.x_file.close(); self.x_file = None
-      self.u_file.close(); self.u_file = None
-      self.p_file.close(); self.p_file = None
-      self.t_file.close(); self.t_file = None
+    self.close_map()
+    if self.geom_file is not None:
+      self.geom_file.close()
+    if self.file != None:
+      self.file.close(); self.file = None
     return
 
-  def seek(self, ielm, readable = False, writable = False):
-    """Move file pointers to point to the ielm-th element and file mode."""
-
-    # Check if file is byte-writable
-    if writable and (self.x_file == None or not self.x_file.writable()):
-      # [re]open as byte-writable
-      if self.x_file != None and not self.x_file.closed:
-        self.x_file.close()
-        self.u_file.close()
-        self.p_file.close()
-        self.t_file.close()
-      self.x_file = open(self.fname, 'wb')
-      self.u_file = open(self.fname, 'wb')
-      self.p_file = open(self.fname, 'wb')
-      self.t_file = open(self.fname, 'wb')
-    # Check if file is byte-readable
-    if readable and (self.x_file == None or not self.x_file.readable()):
-      # [re]open as byte-readable
-      if self.x_file != None and not self.x_file.closed:
-        self.x_file.close()
-        self.u_file.close()
-        self.p_file.close()
-        self.t_file.close()
-      self.x_file = open(self.fname, 'rb')
-      self.u_file = open(self.fname, 'rb')
-      self.p_file = open(self.fname, 'rb')
-      self.t_file = open(self.fname, 'rb')
-
-    # Seek to the right positions
+  def offset(self):
+    """Byte offset of the first field, past the header and element map."""
     if self.padded >= 0:
-      pad = self.padded + self.padded*(int((self.nelm*4 - 1)/self.padded) + 1)
-    else:
-      pad = 136 + self.nelm*4
+      return self.padded + self.padded*(int((self.nelm*4 - 1)/self.padded) + 1)
+    return 136 + self.nelm*4
+
+  def handle(self, writable = False):
+    """The file's one handle, [re]opened if it is closed or read-only."""
+    if self.file == None or (writable and not self.file.writable()):
+      if self.file != None:
+        self.file.close()
+      if writable:
+        self.file = open(self.fname, 'r+b')
+      else:
+        self.file = open(self.fname, 'rb')
+    return self.file
+
+  def where(self, name, ielm):
+    """Byte offset of the ielm-th element of field name."""
+    start, ncomp = self.sections[name]
+    #       header and map -v                field -v   element -v
+    return self.offset() + self.word_size*(start + ielm*ncomp*self.norder**3)
 
-    #        offset -v          header and map -v        field -v
-    self.x_file.seek(ielm*self.word_size*3*self.norder**3 + pad,                 0) 
-    self.u_file.seek(ielm*self.word_size*3*self.norder**3 + pad + 3*self.ntot*self.word_size, 0) 
-    self.p_file.seek(ielm*self.word_size  *self.norder**3 + pad + 6*self.ntot*self.word_size, 0) 
-    self.t_file.seek(ielm*self.word_size  *self.norder**3 + pad + 7*self.ntot*self.word_size, 0) 
+  def pread(self, raw, offset):
+    """Fill the contiguous array raw from the file, starting at byte offset.
 
+    Reads go straight into raw and leave the file position alone, so they
+    are safe to issue from more than one thread.
+    """
+    import numpy as np
+    from os import preadv
+    view = memoryview(raw.view(np.uint8))
+    fd = self.handle().fileno()
+    while len(view) > 0:
+      nread = preadv(fd, [view], offset)
+      if nread == 0:
+        raise EOFError("{:s} ends before byte {:d}".format(self.fname, offset))
+      view = view[nread:]
+      offset += nread
+    return raw
+
+  def pwrite(self, raw, offset):
+    """Write the contiguous array raw to the file, starting at byte offset."""
+    import numpy as np
+    from os import pwrite
+    view = memoryview(raw.view(np.uint8))
+    fd = self.handle(writable = True).fileno()
+    while len(view) > 0:
+      nwrite = pwrite(fd, view, offset)
+      view = view[nwrite:]
+      offset += nwrite
     return
 
-  def get_elem(self, num = 1024, pos = -1):
-    """Read sequential elements."""
+  def memmap(self, mode = 'r'):
+    """Memory map the field section, reusing the map if it is open."""
+    import numpy as np
+    if self.data is not None and self.data.mode != mode:
+      self.close_map()
+    if self.data is None:
+      self.data = np.memmap(self.fname, dtype=self.ty, mode=mode, 
+                            offset=self.offset(), shape=(self.nword,))
+    return self.data
+
+  def close_map(self):
+    """Flush and drop the memory map, if there is one."""
+    if self.data is not None and self.data.mode == 'r+':
+      self.data.flush()
+    self.data = None
+    return
+
+  def views(self, upcast):
+    """In mmap mode, fields that need no upcast or byteswap are views."""
+    import numpy as np
+    return self.mmap and not upcast and np.dtype(self.ty).isnative
+
+  def get_elem(self, num = 1024, pos = -1, upcast = True, fields = ('x', 'u', 'p', 't'), out = None):
+    """Read sequential elements.
+
+    Only the sections named in fields are read; the others are returned as
+    None.  If upcast is False, the fields are returned in the file's dtype
+    and, in mmap mode, are strided views into the map rather than copies.
+    If out is a dict of arrays from buffers(), the fields named in it are
+    read into those arrays, in their dtype, and views of them are returned.
+    """
     import numpy as np
+    if np.ndim(pos) > 0:
+      return self.gather(pos, upcast, fields, out)
     if pos < 0:
       pos = self.current_elm
-      self.seek(self.current_elm, readable = True)
     else:
       self.current_elm = pos
-      self.seek(pos, readable = True)
 
     numl = min(num, self.nelm - pos)
     if numl < 0:
-      return 0, None, None, None
-
-    x_raw = np.fromfile(self.x_file, dtype=self.ty, count = numl*(self.norder**3)*3).astype(np.float64) 
-    u_raw = np.fromfile(self.u_file, dtype=self.ty, count = numl*(self.norder**3)*3).astype(np.float64) 
-    p_raw = np.fromfile(self.p_file, dtype=self.ty, count = numl*(self.norder**3)).astype(np.float64) 
-    t_raw = np.fromfile(self.t_file, dtype=self.ty, count = numl*(self.norder**3)).astype(np.float64) 
-    
-    x = np.reshape(x_raw, (self.norder**3,3,numl), order='F')
-    u = np.reshape(u_raw, (self.norder**3,3,numl), order='F')
-    p =              np.reshape(p_raw, (self.norder**3,  numl), order='F')
-    t =              np.reshape(t_raw, (self.norder**3,  numl), order='F')
+      return 0, None, None, None, None
+
+    # Coordinates may come from a cache or another file instead
+    geom = 'x' in fields and (self.geom_x is not None or not 'x' in self.sections)
+    fields = [f for f in fields if f in self.sections and not (geom and f == 'x')]
+
+    n3 = self.norder**3
+    res = {}
+    for name in fields:
+      ncomp = self.sections[name][1]
+      if self.mmap:
+        # Views are offsets into the map
+        raw = self.section(self.memmap(), name)[:,:,pos:pos+numl]
+      else:
+        # One positioned read per section, into out if it holds file words
+        count = ncomp*n3*numl
+        if out is not None and name in out and out[name].dtype == np.dtype(self.ty):
+          dest = np.reshape(out[name], (-1,), order='F')[:count]
+        elif out is not None and name in out:
+          dest = self.staging(count)
+        else:
+          dest = np.empty(count, dtype=self.ty)
+        raw = np.reshape(self.pread(dest, self.where(name, pos)), (n3,ncomp,numl), order='F')
+      if ncomp == 1:
+        raw = raw[:,0,:]
+      res[name] = self.fill(raw, name, upcast, out)
+    if geom:
+      res['x'] = self.fill(self.geometry(numl, pos), 'x', upcast, out)
 
     self.current_elm += numl
 
-    return numl, x, u, p, t
+    return numl, res.get('x'), res.get('u'), res.get('p'), res.get('t')
 
-  def write(self, x, u, p, t, ielm = -1):
-    """Write one element."""
+  def gather(self, ielm, upcast = True, fields = ('x', 'u', 'p', 't'), out = None):
+    """Read the elements listed in ielm, in that order.
 
-    # create a binary formatter
-    if self.bformat == None:
-      import struct
-      if self.ty == '>f4':
-        fmt = '>{:d}f'.format(self.norder**3)
-      else:
-        fmt = '{:d}f'.format(self.norder**3)
-      self.bformat = struct.Struct(fmt)
+    The elements are fancy-indexed out of the map, so only their pages are
+    read from disk.
+    """
+    import numpy as np
+    idx = np.asarray(ielm, dtype=int)
+    geom = 'x' in fields and (self.geom_x is not None or not 'x' in self.sections)
+    fields = [f for f in fields if f in self.sections and not (geom and f == 'x')]
 
-    # seek where we need to be
-    if ielm >= 0:
-      self.seek(ielm, writable=True)
-    else:
-      self.seek(self.current_elm, writable=True)
+    data = self.memmap()
+    res = {}
+    if geom:
+      res['x'] = self.fill(self.geometry(idx.size, idx), 'x', upcast, out)
+    for name in fields:
+      raw = self.section(data, name)[:,:,idx]
+      if self.sections[name][1] == 1:
+        raw = raw[:,0,:]
+      res[name] = self.fill(raw, name, upcast, out)
+
+    # Leave the map open only if we are in mmap mode
+    if not self.mmap:
+      self.data = None
 
-    # write a single element's worth of data using binary formatter
+    return idx.size, res.get('x'), res.get('u'), res.get('p'), res.get('t')
+
+  def staging(self, count):
+    """Reusable buffer of count file words, for reads that need converting."""
+    import numpy as np
+    if self.stage is None or self.stage.size < count:
+      self.stage = np.empty(count, dtype=self.ty)
+    return self.stage[:count]
+
+  def get_root(self, num = 1024, pos = -1):
+    """Read the first (corner) position of sequential elements.
+
+    Corners come from the geometry cache or the corners saved by
+    get_index() if there are any.  Otherwise they are read through a
+    strided view of the map: only one word per coordinate per element is
+    copied, but at high order every page of the coordinate section is still
+    read from disk.  If pos is an array, the corners of the elements it
+    lists are read instead.
+    """
+    import numpy as np
+    saved = self.geom_root
+    if saved is None:
+      saved = self.saved_corners()
+    if saved is not None:
+      if np.ndim(pos) == 0:
+        if pos < 0:
+          pos = self.current_elm
+        pos = np.arange(pos, min(pos + num, self.nelm))
+      idx = np.asarray(pos, dtype=int)
+      return idx.size, saved[:,idx]
+    if not 'x' in self.sections:
+      if self.geom_file is None:
+        raise ValueError("{:s} has no coordinates; see geometry_from".format(self.fname))
+      return self.geom_file.get_root(num, pos)
+
+    if np.ndim(pos) > 0:
+      idx = np.asarray(pos, dtype=int)
+      corners = self.section(self.memmap(), 'x')[0,:,:]
+      numl, root = idx.size, corners[:,idx].astype(np.float64)
+      if not self.mmap:
+        self.data = None
+      return numl, root
+
+    if pos < 0:
+      pos = self.current_elm
+
+    numl = min(num, self.nelm - pos)
+    if numl < 0:
+      return 0, None
+
+    root = self.section(self.memmap(), 'x')[0,:,pos:pos+numl].astype(np.float64)
+
+    # Leave the map open only if we are in mmap mode
+    if not self.mmap:
+      self.data = None
+
+    return numl, root
+
+  def cache_geometry(self, gname, full = False):
+    """Take element geometry from the cache at gname instead of this file.
+
+    The cache is built from this file if it does not exist yet: the element
+    corners always, as {gname}.root.npy, and the full GLL coordinates too,
+    as {gname}.x.npy, if full is set.  With the full cache, get_elem never
+    reads the coordinate section.  This is only valid while the mesh is
+    fixed, as it is in every frame of a run without mesh motion.
+    """
+    import numpy as np
+    from os import getpid, replace
+    from os.path import exists
+
+    rname = "{:s}.root.npy".format(gname)
+    xname = "{:s}.x.npy".format(gname)
+    if not exists(rname) or (full and not exists(xname)):
+      caches = [(rname, self.get_root(self.nelm, 0)[1])]
+      if full:
+        x = self.get_elem(self.nelm, 0, upcast = False, fields = ('x',))[1]
+        caches.append((xname, x.astype(np.dtype(self.ty).newbyteorder('='))))
+      # Write then rename, so other workers never see a partial cache
+      for name, arr in caches:
+        tname = "{:s}.{:d}.npy".format(name[:-4], getpid())
+        np.save(tname, arr)
+        replace(tname, name)
+
+    self.geom_root = np.load(rname)
+    if full:
+      self.geom_x = np.load(xname, mmap_mode='r')
+    return
+
+  def saved_corners(self):
+    """Element corners (3 x nelm) saved by get_index(), or None if there are
+    none newer than the field file."""
     import numpy as np
-    self.x_file.write(self.bformat.pack(*(x[:,0,0].astype(np.float32).tolist())))
-    self.x_file.write(self.bformat.pack(*(x[:,1,0].astype(np.float32).tolist())))
-    self.x_file.write(self.bformat.pack(*(x[:,2,0].astype(np.float32).tolist())))
+    from os.path import exists, getmtime
+    cname = "{:s}.corners.npy".format(self.fname)
+    if self.corners is None and exists(cname) and getmtime(cname) >= getmtime(self.fname):
+      self.corners = np.load(cname)
+    return self.corners
 
-    self.u_file.write(self.bformat.pack(*(u[:,0,0].astype(np.float32).tolist())))
-    self.u_file.write(self.bformat.pack(*(u[:,1,0].astype(np.float32).tolist())))
-    self.u_file.write(self.bformat.pack(*(u[:,2,0].astype(np.float32).tolist())))
+  def get_index(self, origin, length):
+    """Integer grid coordinates (3 x nelm) of each element's corner.
 
-    self.p_file.write(self.bformat.pack(*(p[:,0].astype(np.float32).tolist())))
-    self.t_file.write(self.bformat.pack(*(t[:,0].astype(np.float32).tolist())))
+    The element corners are read from the coordinate section on first use
+    and saved next to the field file as {fname}.corners.npy, so later opens
+    (and get_root) only read them.  The index is made from them for the
+    given mesh origin and element length, so one saved file serves any mesh.
+    """
+    import numpy as np
+    from os import getpid, replace
+    if self.index is not None:
+      return self.index
 
+    root = self.saved_corners()
+    if root is None:
+      n, root = self.get_root(self.nelm, 0)
+      self.corners = root
+
+      cname = "{:s}.corners.npy".format(self.fname)
+      # Write then rename, so other workers never see partial corners
+      tname = "{:s}.corners.{:d}.npy".format(self.fname, getpid())
+      try:
+        np.save(tname, root)
+        replace(tname, cname)
+      except OSError:
+        # Read-only data directories still get the index in memory
+        pass
+
+    origin = np.reshape(origin, (3,1))
+    length = np.reshape(length, (3,1))
+    self.index = np.array(np.rint((root - origin) / length), dtype=np.int32)
+    return self.index
+
+  def write_map(self, ids):
+    """Write the element map: the global (1-based) id of each element."""
+    import numpy as np
+    order = '>' if self.ty.startswith('>') else '='
+    raw = np.asarray(ids, dtype=np.dtype('i4').newbyteorder(order))
+    self.pwrite(np.ascontiguousarray(raw), self.padded if self.padded >= 0 else 136)
     return
 
+  def write(self, x, u, p, t, ielm = -1):
+    """Write a block of elements.
+
+    Fields are in the (N^3,3,nelm) and (N^3,nelm) layouts that get_elem
+    returns.  If ielm is an array, element i of the block is written to
+    element ielm[i]; otherwise the block is written sequentially starting at
+    ielm (or at the current element).
+    """
+    import numpy as np
+    # Only write the sections this file has
+    blocks = [(name, f) for name, f in (('x', x), ('u', u), ('p', p), ('t', t)) 
+              if name in self.sections]
+
+    # Scattered placement: fancy-index into a writable map of the file
+    if np.ndim(ielm) > 0:
+      idx = np.asarray(ielm, dtype=int)
+      if self.file != None and self.file.writable():
+        self.file.flush()
+      data = self.memmap(mode = 'r+')
+      for name, f in blocks:
+        self.section(data, name)[:,:,idx] = np.reshape(f, (f.shape[0], -1, idx.size), order='F')
+      return
+
+    # Sequential placement: one contiguous write per section
+    if ielm < 0:
+      ielm = self.current_elm
+
+    # The transpose of a Fortran-ordered block is C-contiguous in file order
+    for name, f in blocks:
+      raw = np.ascontiguousarray(np.asfortranarray(f, dtype=self.ty).T)
+      self.pwrite(np.reshape(raw, (-1,)), self.where(name, ielm))
+    self.current_elm = ielm + blocks[0][1].shape[-1]
+
+    return
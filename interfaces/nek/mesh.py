@@ -1,8 +1,14 @@
 
 from interfaces.abstract import AbstractMesh
-from interfaces.nek.sem import zwgll, dhat
+from interfaces.nek.sem import operators
 import numpy as np
 
+# Operators and functions allowed in field expressions
+binops = {'Add': np.add, 'Sub': np.subtract, 'Mult': np.multiply, 
+          'Div': np.divide, 'Pow': np.power}
+funcs  = {'abs': np.abs, 'sqrt': np.sqrt, 'square': np.square, 
+          'exp': np.exp, 'log': np.log}
+
 class UniformMesh(AbstractMesh):
 
   def __init__(self, reader, params):
@@ -15,100 +21,464 @@ class UniformMesh(AbstractMesh):
     self.length = self.extent / self.shape
     self.fields = {}
     self.dealias = 1.
-    z, w = zwgll(self.norder-1)
-    self.gll = self.length[0] * (z+1.)/(2.)
-    self.b1  = w * (self.length[0] / 2.)
-    self.b2  = np.outer(self.b1, self.b1)
-    self.b3  = np.reshape(np.outer(self.b1,self.b2),
-                          (self.norder,self.norder, self.norder))
-    self.d1  = dhat(self.gll)
 
+    # Compute in float64 or in the file's native single precision
+    self.upcast = params.get('upcast', True)
+    if self.upcast:
+      self.dtype = np.dtype(np.float64)
+    else:
+      self.dtype = np.dtype(reader.ty).newbyteorder('=')
+
+    # Operators are shared by every mesh with the same elements
+    ops = [operators(self.norder, float(self.length[i])) for i in range(3)]
+    self.gll = ops[0]['gll']
+    # Quadrature weights along each axis, for elements of any aspect ratio,
+    self.weights = [op['w'] for op in ops]
+    # and derivative matrices, one per axis for the same reason
+    self.d1  = [op['d1'].astype(self.dtype) for op in ops]
+
+    # Elements per chunk when evaluating expressions
+    self.chunk = params.get('chunk', 256)
+    self.temps = []
+    self.vel_axes = {}
     return
 
-  def load(self, pos, num):
-    n, x, u, p, t = self.reader.get_elem(num,pos)
+  def sections(self, fields = None):
+    """File sections behind the named mesh fields."""
+    if fields is None:
+      fields = ('x', 'y', 'z', 'u', 'v', 'w', 'p', 't')
+    section = {'x': 'x', 'y': 'x', 'z': 'x', 
+               'u': 'u', 'v': 'u', 'w': 'u', 
+               'p': 'p', 't': 't'}
+    return set([section[f] for f in fields])
+
+  def buffers(self, num, fields = None):
+    """Arrays load(..., out=) can read num elements of fields into, or None
+    if the reader returns views of the file that need no copying."""
+    if self.reader.views(self.upcast):
+      return None
+    return self.reader.buffers(num, self.upcast, self.sections(fields))
+
+  def load(self, pos, num, fields = None, out = None):
+    """Load a block of elements, reading only the sections behind fields.
+
+    pos can also be an array of element ids, e.g. from select().  If out is
+    from buffers(), the fields are views of those arrays, so nothing is
+    allocated for them.  Readers that return views of the file, like
+    NekFile in mmap mode without upcast, are read without out, so the
+    fields are those views and nothing is copied.
+    """
+    reads = self.sections(fields)
+    if self.reader.views(self.upcast):
+      out = None
+
+    n, x, u, p, t = self.reader.get_elem(num, pos, fields = reads, upcast = self.upcast, out = out)
+    if not self.upcast:
+      # Byteswapped files still need a copy into native order
+      x, u, p, t = [None if f is None else f.astype(self.dtype, copy = False) 
+                    for f in (x, u, p, t)]
     self.nelm = int(n)
     nshp = (self.norder, self.norder, self.norder, self.nelm)
-    self.fields['x'] = np.reshape(x[:,0,:], nshp, order = 'F')
-    self.fields['y'] = np.reshape(x[:,1,:], nshp, order = 'F')
-    self.fields['z'] = np.reshape(x[:,2,:], nshp, order = 'F')
-    self.fields['u'] = np.reshape(u[:,0,:], nshp, order = 'F')
-    self.fields['v'] = np.reshape(u[:,1,:], nshp, order = 'F')
-    self.fields['w'] = np.reshape(u[:,2,:], nshp, order = 'F')
-    self.fields['p'] = np.reshape(p       , nshp, order = 'F')
-    self.fields['t'] = np.reshape(t       , nshp, order = 'F')
+    self.fields = {}
+    if x is not None:
+      self.fields['x'] = np.reshape(x[:,0,:], nshp, order = 'F')
+      self.fields['y'] = np.reshape(x[:,1,:], nshp, order = 'F')
+      self.fields['z'] = np.reshape(x[:,2,:], nshp, order = 'F')
+      self.elm_root = x[0,:,:].astype(np.float64)
+    else:
+      n, self.elm_root = self.reader.get_root(num, pos)
+
+    # Integer element coordinates, and the plane masks and slice plans
+    # built on them
+    self.elm_ijk = np.array(np.rint((self.elm_root - self.origin[:,np.newaxis]) 
+                                    / self.length[:,np.newaxis]), dtype=int)
+    self.planes = {}
+    self.plans = {}
+    self.grads = {}
+    self.exprs = {}
+    self.velocity = None
+    if u is not None:
+      self.velocity = np.reshape(u, nshp[:3] + (3, self.nelm), order = 'F')
+      self.fields['u'] = np.reshape(u[:,0,:], nshp, order = 'F')
+      self.fields['v'] = np.reshape(u[:,1,:], nshp, order = 'F')
+      self.fields['w'] = np.reshape(u[:,2,:], nshp, order = 'F')
+    if p is not None:
+      self.fields['p'] = np.reshape(p       , nshp, order = 'F')
+    if t is not None:
+      self.fields['t'] = np.reshape(t       , nshp, order = 'F')
     return
 
+  def select(self, intercept = None, axis = (), box = None):
+    """Ids of the elements cut by the planes through intercept normal to each
+    of axis, and/or overlapping box = (low corner, high corner).
+
+    Uses the reader's element index, so no field data is read.
+    """
+    index = self.reader.get_index(self.origin, self.length)
+    mask = np.ones(index.shape[1], dtype=bool)
+    for ax in axis:
+      mask &= index[ax,:] == self.cept(intercept, ax)
+    if box is not None:
+      low  = np.floor((np.array(box[0]) - self.origin) / self.length)
+      high = np.ceil( (np.array(box[1]) - self.origin) / self.length)
+      for i in range(3):
+        mask &= (index[i,:] >= low[i]) & (index[i,:] < high[i])
+    return np.nonzero(mask)[0]
+
+  def cept(self, intercept, axis):
+    """Integer element coordinate of intercept along axis."""
+    return int((intercept[axis] - self.origin[axis]) / self.length[axis])
+
+  def plane(self, intercept, axis):
+    """Mask of the loaded elements in the plane through intercept normal
+    to axis, kept until the next load()."""
+    key = (axis, self.cept(intercept, axis))
+    if not key in self.planes:
+      self.planes[key] = self.elm_ijk[axis,:] == key[1]
+    return self.planes[key]
+
   def fld(self, name):
-    return self.fields[name]
+    if name in self.fields:
+      return self.fields[name]
+    return self.expr(name)
 
-  def dx(self, fld, axis):
-    if isinstance(fld, str):
-      fld = self.fld(fld)
+  def chunks(self, srcs):
+    """Evaluate field expressions chunk by chunk, yielding each chunk's
+    element slice and the values of srcs on it.
 
-    res = np.tensordot(self.d1, fld, axes=([1,axis]))
-    if axis == 1:
-      res = res.transpose([1,0,2,3])
-    elif axis == 2:
-      res = res.transpose([2,1,0,3])
+    Shared subexpressions are evaluated once per chunk, and results kept by
+    expr() or dx() are reused.  Derivatives are taken chunk by chunk too,
+    the velocity components together along axes where srcs need more than
+    one of them.  Intermediates go to chunk-sized temporaries that are
+    recycled from chunk to chunk, so the values yielded are only good
+    until the next chunk.
+    """
+    import ast
+    trees = [ast.parse(src, mode='eval').body for src in srcs]
+    self.vel_axes = {}
+    for tree in trees:
+      for call in ast.walk(tree):
+        if type(call).__name__ != 'Call' or call.func.id != 'dx':
+          continue
+        name, axis = getattr(call.args[0], 'id', None), ast.literal_eval(call.args[1])
+        if name in ('u', 'v', 'w') and not (name, axis) in self.grads:
+          self.vel_axes.setdefault(axis, set()).add(name)
+    for start in range(0, self.nelm, self.chunk):
+      sl = np.s_[..., start:min(start + self.chunk, self.nelm)]
+      self.ntemp = 0
+      memo = {}
+      yield sl, [self.node(tree, sl, memo) for tree in trees]
+    return
+
+  def temp(self, *vals):
+    """Next free chunk-sized temporary for the result of an operation on
+    vals, or None if they are all scalars."""
+    shapes = [np.shape(v) for v in vals if np.ndim(v) > 0]
+    if len(shapes) == 0:
+      return None
+    if self.ntemp == len(self.temps):
+      self.temps.append(np.empty((self.norder,)*3 + (self.chunk,), dtype=self.dtype, order='F'))
+    self.ntemp += 1
+    return self.temps[self.ntemp-1][...,:shapes[0][-1]]
 
+  def node(self, tree, sl, memo):
+    """Value of the expression tree on the elements in sl."""
+    import ast
+    key = ast.dump(tree)
+    if key in memo:
+      return memo[key]
+    if key in self.exprs:
+      return self.exprs[key][sl]
+
+    kind = type(tree).__name__
+    if kind == 'Name':
+      res = self.fields[tree.id][sl]
+    elif kind in ('Num', 'Constant'):
+      res = ast.literal_eval(tree)
+    elif kind == 'UnaryOp':
+      res = self.node(tree.operand, sl, memo)
+      if type(tree.op).__name__ == 'USub':
+        res = np.negative(res, out = self.temp(res))
+    elif kind == 'BinOp':
+      left  = self.node(tree.left,  sl, memo)
+      right = self.node(tree.right, sl, memo)
+      if type(tree.op).__name__ == 'Pow' and np.ndim(right) == 0 and right == 2:
+        res = np.square(left, out = self.temp(left))
+      else:
+        res = binops[type(tree.op).__name__](left, right, out = self.temp(left, right))
+    elif kind == 'Call' and tree.func.id == 'dx':
+      axis = ast.literal_eval(tree.args[1])
+      name = tree.args[0].id if type(tree.args[0]).__name__ == 'Name' else None
+      if (name, axis) in self.grads:
+        res = self.grads[(name, axis)][sl]
+      elif len(self.vel_axes.get(axis, ())) > 1 and name in self.vel_axes[axis]:
+        if not ('velocity', axis) in memo:
+          memo[('velocity', axis)] = self.deriv(self.velocity[sl], axis)
+        res = memo[('velocity', axis)][:,:,:,'uvw'.index(name),:]
+      else:
+        res = self.deriv(self.node(tree.args[0], sl, memo), axis)
+    elif kind == 'Call':
+      arg = self.node(tree.args[0], sl, memo)
+      res = funcs[tree.func.id](arg, out = self.temp(arg))
+    else:
+      raise ValueError("Unsupported expression: {:s}".format(key))
+    memo[key] = res
     return res
 
+  def expr(self, *srcs, keep = False):
+    """Full-block values of field expressions, like 'u*u + v*v' or
+    'square(dx(v,0) - dx(u,1))'.
+
+    All of srcs are evaluated in one pass over chunks of elements (see
+    chunks()).  With keep, the results are also kept until the next load()
+    and reused by later expressions.  Returns a list when given several.
+
+    Reductions and slices of an expression don't need it whole: pass the
+    expression itself to int(), max(), min(), profile() or slice(), or
+    several of these to batch().
+    """
+    import ast
+    keys = [ast.dump(ast.parse(src, mode='eval').body) for src in srcs]
+    todo = dict([(key, src) for key, src in zip(keys, srcs) if not key in self.exprs])
+    outs = {}
+    if len(todo) > 0:
+      nshp = (self.norder,)*3 + (self.nelm,)
+      outs = dict([(key, np.empty(nshp, dtype=self.dtype, order='F')) for key in todo])
+      for sl, vals in self.chunks(list(todo.values())):
+        for key, val in zip(todo.keys(), vals):
+          outs[key][sl] = val
+      if keep:
+        self.exprs.update(outs)
+    res = [outs[key] if key in outs else self.exprs[key] for key in keys]
+    if len(res) == 1:
+      return res[0]
+    return res
+
+  def evaluated(self, src):
+    """Whether src is a field or an expression kept by expr()."""
+    import ast
+    return src in self.fields or ast.dump(ast.parse(src, mode='eval').body) in self.exprs
+
+  def batch(self, reqs):
+    """Results of several reductions, with every expression among them
+    evaluated in one pass over chunks of elements (see chunks()), so the
+    subexpressions and derivatives they share are computed once per chunk.
+
+    Each request is (method, fld, *args) for method int, profile, max, min
+    or slice, e.g. ('int', ['u*u', 'v*v']) or ('slice', 'u*u', intercept,
+    (0,1), np.add); its result is what mesh.method(fld, *args) returns.
+    Expressions are never materialized for the whole block.
+    """
+    tasks = []
+    for req in reqs:
+      local, combine, finish = getattr(self, req[0] + '_parts')(*req[2:])
+      flds = req[1] if isinstance(req[1], (list, tuple)) else [req[1]]
+      tasks += [(local, combine, finish, fld) for fld in flds]
+
+    # Arrays, fields and kept expressions are reduced whole
+    srcs = []
+    parts = []
+    for local, combine, finish, fld in tasks:
+      if not isinstance(fld, str):
+        parts.append([local(fld, 0)])
+      elif self.evaluated(fld):
+        parts.append([local(self.fld(fld), 0)])
+      else:
+        if not fld in srcs:
+          srcs.append(fld)
+        parts.append([])
+    if len(srcs) > 0:
+      for sl, vals in self.chunks(srcs):
+        for (local, combine, finish, fld), part in zip(tasks, parts):
+          if isinstance(fld, str) and fld in srcs:
+            part.append(local(vals[srcs.index(fld)], sl[-1].start))
+
+    results = []
+    for (local, combine, finish, fld), part in zip(tasks, parts):
+      if len(part) == 1:
+        res = part[0]
+      elif combine is not None:
+        res = combine.reduce(part)
+      else:
+        res = np.concatenate(part, axis=-1)
+      results.append(finish(res))
+
+    # Regroup by request
+    out = []
+    for req in reqs:
+      if isinstance(req[1], (list, tuple)):
+        out.append(results[:len(req[1])])
+        results = results[len(req[1]):]
+      else:
+        out.append(results.pop(0))
+    return out
+
+  def combiner(self, ufunc, axis):
+    """How batch() merges chunks reduced with ufunc over axis: with ufunc
+    if the elements are reduced, otherwise None to join them."""
+    if 3 in np.atleast_1d(axis):
+      return ufunc
+    return None
+
+  def deriv(self, fld, axis):
+    """Derivative along axis of an array of element fields shaped
+    (N,N,N,...), as one batched product with d1 and no transposed copies."""
+    fld = np.asfortranarray(fld)
+    before = self.norder**axis
+    g = np.reshape(fld, (before, self.norder, -1), order = 'F').T
+    if before == 1:
+      res = np.matmul(g[:,:,0], self.d1[axis].T)[:,:,np.newaxis]
+    else:
+      res = np.matmul(self.d1[axis], g)
+    return np.reshape(res.T, fld.shape, order = 'F')
+
+  def dx(self, fld, axis, keep = False):
+    """Derivative of fld along axis.  With keep, and fld a name, it is
+    kept until the next load() and reused, also by expressions."""
+    if not isinstance(fld, str):
+      return self.deriv(fld, axis)
+    if (fld, axis) in self.grads:
+      return self.grads[(fld, axis)]
+    res = self.deriv(self.fld(fld), axis)
+    if keep:
+      self.grads[(fld, axis)] = res
+    return res
+
+  def grad(self, fld, keep = False):
+    """Derivatives of fld along each axis."""
+    if isinstance(fld, str) and fld in ('u', 'v', 'w'):
+      return self.velocity_gradient(keep)['uvw'.index(fld)]
+    return [self.dx(fld, axis, keep) for axis in range(3)]
+
+  def velocity_gradient(self, keep = False):
+    """Velocity gradient g[i][j] = du_i/dx_j, with all three components
+    differentiated together along each axis.  With keep, the nine
+    derivatives are kept until the next load()."""
+    grads = {}
+    for axis in range(3):
+      if all([(name, axis) in self.grads for name in 'uvw']):
+        continue
+      res = self.deriv(self.velocity, axis)
+      for i, name in enumerate('uvw'):
+        grads[(name, axis)] = res[:,:,:,i,:]
+    if keep:
+      self.grads.update(grads)
+    grads.update(self.grads)
+    return [[grads[(name, axis)] for axis in range(3)] for name in 'uvw']
+
   def int(self, fld, axis = (0,1,2,3)):
-    if isinstance(fld, str):
-      fld = self.fld(fld)
+    """Integral of fld over axis with the GLL weights of each axis.
+
+    axis=(0,1,2) gives per-element integrals.  fld can be a list, in which
+    case a list of integrals is returned, with the expressions in it
+    evaluated together.  The weights are contracted in one einsum, so no
+    block-sized weight array is built.
+    """
+    return self.batch([('int', fld, axis)])[0]
+
+  def int_parts(self, axis = (0,1,2,3)):
+    """int() as the local, combine and finish functions batch() takes."""
+    kept = ''.join([c for i, c in enumerate('ijke') if not i in np.atleast_1d(axis)])
+    def local(fld, start):
+      return np.einsum('ijke,i,j,k->' + kept, fld, *self.weights, dtype=np.float64)
+    return local, self.combiner(np.add, axis), lambda res: res
+
+  def profile(self, fld, axis = 2):
+    """Integral of fld over each plane of points normal to axis, on the
+    grid used by slice(); the profile sums to the full integral.
+
+    Points shared by neighboring elements share a bin.  fld can be a list.
+    """
+    return self.batch([('profile', fld, axis)])[0]
 
-    # Note, this isn't quite right
-    foo = fld * np.tile(self.b3, (self.nelm,1,1,1)).transpose()
-    return np.add.reduce(foo, axis)
+  def profile_parts(self, axis = 2):
+    """profile() as the local, combine and finish functions batch() takes."""
+    n1 = self.norder - 1
+    sub = 'ijk'[axis] + 'e'
+    def local(fld, start):
+      return np.einsum('ijke,i,j,k->' + sub, fld, *self.weights, dtype=np.float64)
+    idx = np.arange(self.norder)[:,np.newaxis] + self.elm_ijk[axis][np.newaxis,:]*n1
+    def finish(part):
+      return np.bincount(idx.ravel(), weights=part.ravel(), minlength=int(self.shape[axis])*n1 + 1)
+    return local, None, finish
 
   def max(self, fld, axis = (0,1,2,3)):
-    if isinstance(fld, str):
-      fld = self.fld(fld)
-    return np.maximum.reduce(fld,axis)
+    return self.batch([('max', fld, axis)])[0]
+
+  def max_parts(self, axis = (0,1,2,3)):
+    """max() as the local, combine and finish functions batch() takes."""
+    return (lambda f, start: np.maximum.reduce(f, axis), 
+            self.combiner(np.maximum, axis), lambda res: res)
 
   def min(self, fld, axis = (0,1,2,3)):
-    if isinstance(fld, str):
-      fld = self.fld(fld)
-    return np.minimum.reduce(fld,axis)
+    return self.batch([('min', fld, axis)])[0]
+
+  def min_parts(self, axis = (0,1,2,3)):
+    """min() as the local, combine and finish functions batch() takes."""
+    return (lambda f, start: np.minimum.reduce(f, axis), 
+            self.combiner(np.minimum, axis), lambda res: res)
+
+  def plan(self, intercept, axis, op = None):
+    """Flat indices into the slice of each element's points, the elements
+    that contribute (None for all) and the slice shape.
+
+    Plans only depend on the element roots, so they are kept until the
+    next load() and shared by every field sliced the same way.
+    """
+    key = (tuple(axis), op is None) + ((tuple(intercept),) if op is None else ())
+    if key in self.plans:
+      return self.plans[key]
+
+    n1 = self.norder - 1
+    full_shape = self.shape * n1 + 1
+    keep = [i for i in range(3) if not i in axis]
+    slice_shape = tuple([full_shape[i]-1 for i in keep])
+
+    # With no op, only elements at the intercept contribute
+    sel = None
+    root = self.elm_ijk
+    if op is None:
+      here = np.ones(self.nelm, dtype=bool)
+      for i in axis:
+        here = here & self.plane(intercept, i)
+      sel = np.nonzero(here)[0]
+      root = root[:,sel]
+
+    # Index of point (a, [b,] elm) in the C-ordered slice
+    span = np.arange(n1)
+    idx = 0
+    for d, i in enumerate(keep):
+      shp = [1]*(len(keep)+1)
+      shp[d] = n1
+      idx = idx * slice_shape[d] + (np.reshape(span, shp) + root[i,:]*n1)
+    idx = np.ravel(idx)
+
+    self.plans[key] = (idx, sel, slice_shape)
+    return self.plans[key]
 
   def slice(self, fld, intercept, axis, op = None):
-    if isinstance(fld, str):
-      fld = self.fld(fld)
-    full_shape = self.shape * (self.norder-1) + 1
-    slice_shape = []
-    root = []
-    cept = []
-    root2 = []
-    p = ['x', 'y', 'z']
-    for i in range(3):
-      if not i in axis:
-        slice_shape.append(full_shape[i]-1)
-        root.append(np.array((self.fields[p[i]][0,0,0,:] -self.origin[i]) / self.length[i], dtype=int))
-      else:
-        root2.append(np.array((self.fields[p[i]][0,0,0,:] -self.origin[i]) / self.length[i], dtype=int))
-        cept.append(int((intercept[i] -self.origin[i]) / self.length[i]))
-
-    slice = np.zeros(slice_shape)
-    if op != None:
-      local = op.reduce(fld[:-1,:-1,:-1,:], axis)
-      for i in range(self.nelm):
-        foo = local[...,i]
-        starti = [7*root[j][i] for j in range(len(root))]
-        endi = [x + self.norder - 1 for x in starti]
-        sl = tuple([np.s_[starti[j]:endi[j]] for j in range(len(root))])
-        slice[sl] += foo
-    else:
-      local = fld[:-1,:-1,:-1,:]
-      for i in range(self.nelm):
-        here = all([root2[j][i] == cept[j] for j in range(len(cept))])
-        if not here: 
-          continue
-        sl = tuple([np.s_[0] if ax in axis else np.s_[:] for ax in range(3)] + [np.s_[i]])
-        foo = local[sl]
-        starti = [7*root[j][i] for j in range(len(root))]
-        endi = [x + self.norder - 1 for x in starti]
-        sl = tuple([np.s_[starti[j]:endi[j]] for j in range(len(root))])
-        slice[sl] += foo
-    
-    return slice
+    """Slice fld at intercept normal to axis or, with op, reduce along axis.
+
+    fld can be a name, an expression, an array or a list of these, in which
+    case a list of slices is returned.  Expressions are evaluated chunk by
+    chunk, and those in a list together, like in int().  Element
+    contributions are scatter-added in one pass, so shared points add as
+    they would element by element.
+    """
+    return self.batch([('slice', fld, intercept, axis, op)])[0]
+
+  def slice_parts(self, intercept, axis, op = None):
+    """slice() as the local, combine and finish functions batch() takes."""
+    idx, sel, slice_shape = self.plan(intercept, axis, op)
+
+    def local(fld, start):
+      if op != None:
+        return op.reduce(fld[:-1,:-1,:-1,:], axis)
+      sl = tuple([0 if ax in axis else np.s_[:-1] for ax in range(3)])
+      mine = sel[(sel >= start) & (sel < start + fld.shape[-1])] - start
+      return fld[sl][...,mine]
+
+    def finish(local):
+      slice = np.bincount(idx, weights=np.ravel(local), minlength=int(np.prod(slice_shape)))
+      return np.reshape(slice, slice_shape)
+    return local, None, finish
@@ -1,3 +1,5 @@
+from functools import lru_cache
+
 def zwgll(p):
   """
   computes the p+1 Gauss-Lobatto-Legendre nodes z on [-1,1]
@@ -127,19 +129,54 @@ def dhat(x):
             w = D*u   
             -     -
      returns the derivative of u at the points x_i.
+
+     Built from the barycentric weights of x, rather than a stencil per node.
   """
   import numpy as np
-  n1 = x.shape[0]
-  w = np.zeros((n1,2))
-  Dh = np.zeros((n1,n1));
+  diff = x[:,np.newaxis] - x[np.newaxis,:]
+  np.fill_diagonal(diff, 1.)
+  bary = 1. / np.prod(diff, axis=1)
 
-  for i in range(n1):
-    w = fd_weights_full(x[i],x,1)
-    Dh[:,i] = w[:,1]
-
-  Dh = np.transpose(Dh)
+  Dh = (bary[np.newaxis,:] / bary[:,np.newaxis]) / diff
+  np.fill_diagonal(Dh, 0.)
+  np.fill_diagonal(Dh, -np.sum(Dh, axis=1))
   return Dh
 
+def lagrange_matrix(x, y):
+  """ Matrix M_ij of the Lagrange polynomial through nodes x_j evaluated at y_i,
+      which interpolates from x to y.
+  """
+  import numpy as np
+  n1 = x.shape[0]
+  diff = x[:,np.newaxis] - x[np.newaxis,:]
+  np.fill_diagonal(diff, 1.)
+
+  # Products over k != j of (y_i - x_k), with the k == j factor set to one
+  num = np.repeat((y[:,np.newaxis] - x[np.newaxis,:])[:,np.newaxis,:], n1, axis=1)
+  num[:, np.arange(n1), np.arange(n1)] = 1.
+  return np.prod(num, axis=2) / np.prod(diff, axis=1)[np.newaxis,:]
+
+@lru_cache(maxsize = None)
+def operators(order, length, ninterp = 0):
+  """ GLL operators for elements of the given order and length along one axis:
+      the nodes (gll), quadrature weights (w) and derivative matrix (d1), and,
+      if ninterp > 0, the ninterp uniform points (cart) and the matrix that
+      interpolates to them (trans).
+
+      Cached on the arguments, so meshes and transforms of the same element
+      share them; the arrays are read-only.
+  """
+  import numpy as np
+  z, w = zwgll(order-1)
+  ops = {'gll': length * (z + 1.) / 2., 'w': w * (length / 2.)}
+  ops['d1'] = dhat(ops['gll'])
+  if ninterp > 0:
+    ops['cart']  = np.linspace(0., length, num=ninterp, endpoint=False)
+    ops['trans'] = lagrange_matrix(ops['gll'], ops['cart'])
+  for key in ops:
+    ops[key].setflags(write=False)
+  return ops
+
 def interp_mat(x, y, order = 0):
   """ Compute the interpolatory derivative matrix P_ij associated with nodes x_j such that
                 ^
@@ -161,7 +198,6 @@ def interp_mat(x, y, order = 0):
   return Ph
 
 def semhat(N):
-  from sem import zwgll
   import numpy as np
   z, w = zwgll(N)
 
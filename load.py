@@ -13,6 +13,13 @@ import json
 with open("{:s}.json".format(args.name), 'r') as f:
   params = json.load(f)
 
+# Catalog the file headers, so frames are scheduled without opening files
+from importlib import import_module
+MR = import_module(args.mapreduce)
+if hasattr(MR, "get_fname"):
+  from interfaces.nek.catalog import update_catalog
+  update_catalog(args.name, params, range(args.frame, args.frame_end+1), MR.get_fname)
+
 # Set up the frame arguments
 from parallel.procs import outer_process
 jobs = [[args, params, i] for i in range(args.frame, args.frame_end+1)]
@@ -0,0 +1,35 @@
+"""
+State kept by a job from one block to the next
+"""
+
+class BlockContext:
+  """Per-job state handed to every map_ call.
+
+  Holds the job's reader, plus a mesh and block buffers that are made on
+  first use and reused for the rest of the job, so each block only reads
+  and computes.  work is a dict for map_'s own scratch arrays.
+  """
+  def __init__(self, reader, params):
+    self.reader  = reader
+    self.params  = params
+    self.mesh    = None
+    self.buffers = {}
+    self.work    = {}
+    return
+
+  def get_mesh(self):
+    """The job's UniformMesh, built once."""
+    if self.mesh is None:
+      from interfaces.nek.mesh import UniformMesh
+      self.mesh = UniformMesh(self.reader, self.params)
+    return self.mesh
+
+  def get_buffers(self, num, fields = None):
+    """Buffers for blocks of up to num elements of fields, from the mesh.
+
+    The same buffers are returned until a larger block is asked for.
+    """
+    key = None if fields is None else tuple(fields)
+    if not key in self.buffers or self.buffers[key][0] < num:
+      self.buffers[key] = (num, self.get_mesh().buffers(num, fields))
+    return self.buffers[key][1]
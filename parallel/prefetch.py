@@ -0,0 +1,144 @@
+"""
+Read-ahead of element blocks, overlapping I/O with the map
+"""
+
+from interfaces.abstract import AbstractFileReader
+
+class PrefetchReader(AbstractFileReader):
+  """Wrap a reader, reading the next blocks in a background thread.
+
+  Blocks are (pos, num) pairs in the order they will be asked for.  The
+  first get_elem call fixes the keyword arguments (fields, upcast) used for
+  the rest of the blocks; any call that does not match the next block is
+  read directly, so a reader wrapped here behaves exactly like the bare one.
+
+  If that first call passes out= buffers, the thread reads into a pool of
+  depth+2 buffers shaped like them, and blocks are returned in the pool's
+  buffers instead of out.  A block's buffers go back to the pool at the
+  next get_elem call, so, as with out, its fields are only good until
+  then, and nothing is allocated or copied per block.
+
+  Blocks read without coordinates come with their element roots, so the
+  get_root call that follows does not wait on the reader while the
+  thread holds it for the next block.
+  """
+  def __init__(self, reader, blocks, depth = 1):
+    from queue import Queue
+    from threading import Lock, Event
+    self.reader = reader
+    self.blocks = list(blocks)
+    self.depth  = max(depth, 1)
+    self.queue  = Queue(maxsize = self.depth)
+    self.free   = None
+    self.lent   = None
+    self.lock   = Lock()
+    self.done   = Event()
+    self.thread = None
+    self.kwargs = None
+    self.iblock = 0
+    self.roots  = None
+    return
+
+  def __getattr__(self, name):
+    # Everything else (norder, nelm, time, ...) comes from the reader
+    return getattr(self.__dict__['reader'], name)
+
+  def start(self, kwargs, out = None):
+    """Start reading blocks in the background with these keyword arguments."""
+    from queue import Queue
+    from threading import Thread
+    import numpy as np
+    self.kwargs = kwargs
+    if out is not None:
+      self.free = Queue()
+      # depth blocks queued, one being read and one lent to the caller
+      for i in range(self.depth + 2):
+        self.free.put(dict([(k, np.empty_like(out[k])) for k in out]))
+    self.thread = Thread(target = self.run)
+    self.thread.daemon = True
+    self.thread.start()
+    return
+
+  def run(self):
+    """Read each block into the queue, which blocks when it is full."""
+    from queue import Empty
+    for pos, num in self.blocks:
+      # Wait for a free buffer, unless we are being closed
+      bufs = None
+      while self.free is not None and bufs is None:
+        if self.done.is_set():
+          return
+        try:
+          bufs = self.free.get(timeout = 0.01)
+        except Empty:
+          pass
+      if self.done.is_set():
+        return
+      try:
+        with self.lock:
+          res = self.reader.get_elem(num, pos, out = bufs, **self.kwargs)
+          roots = None
+          if res[1] is None:
+            roots = self.reader.get_root(num, pos)
+      except Exception as e:
+        self.queue.put((e, bufs, None))
+        return
+      self.queue.put((res, bufs, roots))
+    return
+
+  def get_elem(self, num = 1024, pos = -1, out = None, **kwargs):
+    """Return the next prefetched block, or read directly if out of order."""
+    import numpy as np
+    if self.thread is None:
+      self.start(kwargs, out)
+
+    # The caller is done with the last block, so its buffers can be refilled
+    if self.lent is not None:
+      self.free.put(self.lent)
+      self.lent = None
+
+    if (np.ndim(pos) == 0 and self.iblock < len(self.blocks)
+        and kwargs == self.kwargs and (out is None) == (self.free is None)
+        and self.blocks[self.iblock] == (pos, num)):
+      self.iblock += 1
+      res, bufs, roots = self.queue.get()
+      if isinstance(res, Exception):
+        raise res
+      self.roots = ((pos, num), roots)
+      self.lent = bufs
+      return res
+
+    with self.lock:
+      return self.reader.get_elem(num, pos, out = out, **kwargs)
+
+  def views(self, upcast):
+    return self.reader.views(upcast)
+
+  def get_root(self, num = 1024, pos = -1):
+    import numpy as np
+    # Roots of the block just served were read along with it
+    if (np.ndim(pos) == 0 and self.roots is not None and self.roots[0] == (pos, num) 
+        and self.roots[1] is not None):
+      return self.roots[1]
+    with self.lock:
+      return self.reader.get_root(num, pos)
+
+  def get_index(self, origin, length):
+    with self.lock:
+      return self.reader.get_index(origin, length)
+
+  def close(self):
+    """Stop the reader thread and close the underlying reader."""
+    from queue import Empty
+    self.done.set()
+    if self.thread is not None:
+      # Unblock a reader waiting on a full queue
+      while self.thread.is_alive():
+        try:
+          self.queue.get(timeout = 0.01)
+        except Empty:
+          pass
+      self.thread.join()
+      self.thread = None
+    self.reader.close()
+    return
@@ -77,23 +77,48 @@ def inner_process(job):
   #res = deepcopy(ans_in)
   ans = deepcopy(ans_in)
 
-  # Open the data file
-  from interfaces.nek.files import NekFile
-  input_file = NekFile(fname)
+  # Split the range into blocks
+  blocks = [(pos, min(args.block, elm_range[1] - pos)) 
+            for pos in range(elm_range[0], elm_range[1], args.block)]
+
+  # Open the data file, reading ahead of the map if asked
+  from interfaces.nek.chunked import chunked_name, quantized_name, is_current
+  if args.quantized and is_current(quantized_name(fname), fname):
+    # Lossy copies are only read when asked for
+    from interfaces.nek.chunked import ChunkedFile
+    input_file = ChunkedFile(quantized_name(fname))
+  elif is_current(chunked_name(fname), fname):
+    # An up-to-date converted copy is cheaper to read than the original
+    from interfaces.nek.chunked import ChunkedFile
+    input_file = ChunkedFile(chunked_name(fname))
+  else:
+    from interfaces.nek.files import NekFile, geometry_name
+    input_file = NekFile(fname, mmap = args.mmap)
+    # Frames without coordinates share those of the first frame
+    input_file.geometry_from()
+    if args.geometry != "none":
+      input_file.cache_geometry(geometry_name(fname, params), full = (args.geometry == "full"))
+  if args.prefetch > 0:
+    from parallel.prefetch import PrefetchReader
+    input_file = PrefetchReader(input_file, blocks, depth = args.prefetch)
   #res['time'] = input_file.time
   print("Processed {:s}".format(fname))
 
-  # Loop over maps and local reduces
-  for pos in range(elm_range[0], elm_range[1], args.block):
-    # make sure we don't read past this thread's range
-    nelm_to_read = min(args.block, elm_range[1] - pos)
+  # State that map_ keeps from block to block, for maps that take it
+  from inspect import signature
+  from parallel.context import BlockContext
+  extra = {}
+  if 'context' in signature(MR.map_).parameters:
+    extra['context'] = BlockContext(input_file, params)
 
-    # All the work is here!
-    MR.map_(input_file, pos, nelm_to_read, params, ans)
+  # Loop over maps and local reduces, holding the file open throughout
+  with input_file:
+    for pos, nelm_to_read in blocks:
+      # All the work is here!
+      MR.map_(input_file, pos, nelm_to_read, params, ans, **extra)
 
-    # This reduce is more of a combiner
-    MR.reduce_(res, ans)
+      # This reduce is more of a combiner
+      MR.reduce_(res, ans)
 
-  input_file.close()
   return res
 
@@ -1,52 +1,95 @@
-def MR_init(args, params):
+
+def get_fname(name, proc, frame, params):
+  from math import log10
+  from os.path import dirname, basename
+  data_path = dirname(name)
+  data_tag  = basename(name) 
+  dir_width = int(log10(max(abs(params["io_files"])-1,1)))+1
+  if params["io_files"] > 0:
+    fname = "{:s}{:0{width}d}.f{:05d}".format(name, proc, frame, width=dir_width)
+  else:
+    fname = "{:s}/A{:0{width}d}/{:s}{:0{width}d}.f{:05d}".format(data_path, proc, data_tag, proc, frame, width=dir_width)
+  return fname
+
+def lexicographic_index(root, params):
+  """ Standard global index of elements with corners root (3 x nelm) """
+  import numpy as np
+
+  # Nicer names
+  origin = np.array(params["root_mesh"])[:,np.newaxis]
+  corner = np.array(params["extent_mesh"])[:,np.newaxis]
+  shape  = np.array(params["shape_mesh"], dtype=int)
+
+  ijk = np.array(0.5 + (root - origin) * shape[:,np.newaxis] / (corner - origin), dtype=int)
+  return ijk[0] + shape[0] * (ijk[1] + shape[1] * ijk[2])
+
+def MR_init(args, params, frame):
   """ Initialize MapReduce data """
-  from nek import NekFile
+  import numpy as np
+  from copy import deepcopy
+  from interfaces.nek.files import NekFile
 
-  # Open input and output Nek files
-  input_file = NekFile(args.fname)
-  output_file = NekFile("{:s}.rpkg".format(args.fname), input_file)
+  # base cases
+  ans = {}
+  ans['nelm'] = 0
 
-  # return a cleaned up version of locals
-  ans = locals()
-  del ans['args']
-  del ans['NekFile']
+  njob_per_file = max(1+int((args.thread-1) / abs(int(params["io_files"]))),1)
+  jobs = []
+  for j in range(abs(int(params["io_files"]))):
+      fname = get_fname(args.name, j, frame, params)
+      input_file = NekFile(fname)
+      ans["time"] = input_file.time
+      # Frames without coordinates share those of the first frame
+      input_file.geometry_from()
 
-  return ans
+      # Sorted global indices of this file's elements: an element's rank 
+      # in this list is its position in the repacked file
+      n, root = input_file.get_root(input_file.nelm, 0)
+      ans["jelm"] = np.sort(lexicographic_index(root, params))
+
+      # Create the output file, sized for out-of-order writes, with the
+      # element map of the new order
+      ans["output"] = "{:s}.rpkg".format(fname)
+      output_file = NekFile(ans["output"], input_file)
+      output_file.write_map(ans["jelm"] + 1)
+      output_file.close()
+
+      elm_per_thread = int((input_file.nelm-1) / njob_per_file) + 1
+      for i in range(njob_per_file):
+          jobs.append([
+              (i * elm_per_thread, min((i+1)*elm_per_thread, input_file.nelm)),
+              fname,
+              params,
+              args,
+              deepcopy(ans)])  
+      input_file.close()
+  return jobs
 
-def map_(pos, vel, p, t, params, ans = None):
+def map_(input_file, pos, nelm_to_read, params, scratch = None, context = None):
   """ Map operations onto chunk of elements """
+  import numpy as np
+  from interfaces.nek.files import NekFile
 
-  # Nicer names
-  root   = params["root_mesh"]
-  extent = params["extent_mesh"]
-  shape  = params["shape_mesh"]
-
-  # Loop over chunk of elements elements
-  for ielm in range(pos.shape[2]):
-    ix = int(0.5 + (pos[0,0,ielm] - root[0]) * shape[0] / (extent[0] - root[0]))
-    iy = int(0.5 + (pos[0,1,ielm] - root[1]) * shape[1] / (extent[1] - root[1]))
-    iz = int(0.5 + (pos[0,2,ielm] - root[2]) * shape[2] / (extent[2] - root[2]))
-
-    # Compute standard global index
-    jelm = int(ix + iy * shape[0] + iz * shape[0] * shape[1])
-
-    # write element in that position
-    """
-    ans["output_file"].write(pos[:,:,ielm:ielm+1], 
-                             vel[:,:,ielm:ielm+1], 
-                             p[:,ielm:ielm+1], 
-                             t[:,ielm:ielm+1], 
-                             ielm = jelm)
-    """
-
-  return
+  ans = {}
+  if scratch != None:
+    ans = scratch
 
-def reduce_(whole, part):
-  """ Reduce results into a single output object (dict) """
+  # Read the block in the file's own precision
+  n, x, u, p, t = input_file.get_elem(nelm_to_read, pos, upcast = False)
 
-  # Close the files
-  part["output_file"].close()
-  part["input_file"].close()
+  # Target positions of the whole block at once
+  target = np.searchsorted(ans["jelm"], lexicographic_index(x[0,:,:], params))
 
-  return 
+  # Targets are a permutation, so jobs never write the same element.  The
+  # output is named in MR_init, as the reader may be a converted copy
+  output_file = NekFile(ans["output"])
+  output_file.write(x, u, p, t, ielm = target)
+  output_file.close()
 
+  ans['nelm'] = n
+  return ans
+
+def reduce_(whole, part):
+  """ Reduce results into a single output object (dict) """
+  whole['nelm'] = whole['nelm'] + part['nelm']
+  return 
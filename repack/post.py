@@ -16,21 +16,22 @@ def post_series(results, params, args):
   return
 
 
-def post_frame(results, args, params, frame, time):
+def post_frame(results, params, args):
   """Post-process single frame results, outputting to screen or files.
 
   Keyword arguments:
   results -- ouput of process_work
-  args    -- namespace of commandline arguments from ArgumentParser
   params  -- dictionary of problem parameters read from {name}.json
-  frame -- integer frame number
-  time -- real time stamp
+  args    -- namespace of commandline arguments from ArgumentParser
   """
 
-  # Close the input and output files and delete their references
-  results["output_file"].close()
-  del results["output_file"]
-  del results["input_file"]
+  # The element ordering is only needed by the map
+  del results["jelm"]
+  if args.verbose:
+    print("  Repacked {:d} elements".format(results["nelm"]))
 
   return 
 
+def plot_frame(results, params, args):
+  """Nothing to plot for a repack."""
+  return
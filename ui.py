@@ -46,6 +46,18 @@ def command_line_ui():
                  help="Compute box covering numbers")
   p.add_argument("-nb", "--block", type=int, default=65536,
                  help="Number of elements to process at a time")
+  p.add_argument("-mm", "--mmap", action="store_true", default=False,
+                 help="Read field files through a memory map")
+  p.add_argument("-g",  "--geometry", choices=["none", "roots", "full"], default="none",
+                 help="Cache element corners (or all coordinates) from the first frame read")
+  p.add_argument("-sp", "--single", action="store_true", default=False,
+                 help="Compute in the file's single precision (reductions stay double)")
+  p.add_argument("-pf", "--prefetch", type=int, default=1,
+                 help="Number of blocks to read ahead of the map (0 to disable)")
+  p.add_argument("-q",  "--quantized", action="store_true", default=False,
+                 help="Read lossy, quantized copies of the field files where they exist")
+  p.add_argument(       "--bounds", nargs="*", default=[],
+                 help="Quantize fields when converting, e.g. t=1e-3 u=1e-4 (lossy)")
   p.add_argument("-nt", "--thread", type=int, default=1,
                  help="Number of threads to spawn")
   p.add_argument("-d",  "--display", action="store_true", default=False,  
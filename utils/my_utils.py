@@ -46,44 +46,110 @@ def find_root(x, y, y0 = .5, desired_resolution = None):
     x_guess = (x_high + x_low)/2.
   return x_guess
 
+def find_roots(x, y, y0 = .5):
+  """Where each column of y (..., nz) falls through y0, on coordinates x (nz).
+
+  Like find_root, the first crossing is used if y0 >= .5 and the last one
+  otherwise.  The crossing is bracketed with argmax, then x is found by
+  inverting the cubic through the four surrounding points; if that lands
+  outside the bracket, linear interpolation is used instead.  Columns that
+  never cross y0 give nan.
+  """
+  import numpy as np
+  x = np.asarray(x, dtype=np.float64)
+  y = np.asarray(y, dtype=np.float64)
+  nz = x.shape[0]
+
+  # k brackets the crossing: y[k] > y0 >= y[k+1]
+  cross = (y[...,:-1] > y0) & (y[...,1:] <= y0)
+  if y0 >= .5:
+    k = np.argmax(cross, axis=-1)
+  else:
+    k = nz - 2 - np.argmax(cross[...,::-1], axis=-1)
+  found = np.any(cross, axis=-1)
+
+  # Four points around the bracket, shifted to stay inside the column
+  start = np.clip(k - 1, 0, max(nz - 4, 0))
+  idx = start[...,np.newaxis] + np.arange(min(nz, 4))
+  xs = x[idx]
+  ys = np.take_along_axis(y, idx, axis=-1)
+
+  # Inverse interpolation: x as a polynomial in y, evaluated at y0
+  dy = ys[...,:,np.newaxis] - ys[...,np.newaxis,:]
+  eye = np.eye(idx.shape[-1], dtype=bool)
+  with np.errstate(divide='ignore', invalid='ignore'):
+    basis = np.prod(np.where(eye, 1., (y0 - ys[...,np.newaxis,:]) / np.where(eye, 1., dy)), axis=-1)
+    root = np.sum(basis * xs, axis=-1)
+
+    # Fall back to a straight line between the bracketing points
+    y_lo = np.take_along_axis(y, k[...,np.newaxis],     axis=-1)[...,0]
+    y_hi = np.take_along_axis(y, k[...,np.newaxis] + 1, axis=-1)[...,0]
+    line = x[k] + (x[k+1] - x[k]) * (y_lo - y0) / (y_lo - y_hi)
+  bad = ~np.isfinite(root) | (root < np.minimum(x[k], x[k+1])) | (root > np.maximum(x[k], x[k+1]))
+  root = np.where(bad, line, root)
+  return np.where(found, root, np.nan)
+
 """ Build Lagrange interpolation matrix """
 def lagrange_matrix(A,B):
-  import numpy as np
-  M = np.zeros((B.size,A.size), order='F', dtype=np.float64)
-  for i in range(A.size):
-    for j in range(B.size):
-      M[j,i] =  1.
-      for k in range(A.size):
-        if k == i:
-          continue
-        M[j,i] = M[j,i] * (B[j] - A[k]) / (A[i] - A[k])
-  return M
-
-def transform_field_elements(f, trans, cart):
+  from interfaces.nek.sem import lagrange_matrix
+  return lagrange_matrix(A, B)
+
+# Words of scratch per tile of elements, about what fits in L2
+cache_words = 1 << 17
+
+def transform_field_elements(f, trans, cart, out = None, work = None, tile = None):
+  """Interpolate elements f (norder**3 x nelm) with trans along each axis.
+
+  The result (ninterp**3 x nelm) is written into out if it is given.  work
+  is a dict of scratch arrays, filled on first use and reused by later
+  calls that pass the same dict with the same shapes.
+
+  Elements go through all three contractions a tile at a time, so the
+  scratch for a tile stays in cache; tile overrides the number of
+  elements per tile.
+  """
   from tictoc import tic, toc
   import numpy as np
-  import gc
   ninterp = trans.shape[0]
   norder = trans.shape[1]
   nelm = f.shape[1]
 
-  tic()
-  # Transform to uniform grid
-  # z-first
-  f_p = np.reshape(np.transpose(np.reshape(f, (norder**2, norder, nelm), order='F'), (1,0,2)), (norder, norder**2*nelm), order='F')
-  f_tmp = np.reshape(np.transpose(np.reshape(trans.dot(f_p), (ninterp, norder**2, nelm), order='F'), (1,0,2)), (norder, norder*ninterp*nelm), order='F')
+  # Work in the precision of the field, not of the operator
+  trans = trans.astype(f.dtype, copy=False)
+
+  if tile is None:
+    tile = max(1, cache_words // (norder * max(norder, ninterp)**2))
+  tile = max(1, min(tile, nelm))
+  if work is None:
+    work = {}
+  shapes = {'x': (tile, norder, norder, ninterp), 'y': (tile, norder, ninterp, ninterp)}
+  for key in shapes:
+    if not key in work or work[key].shape != shapes[key] or work[key].dtype != f.dtype:
+      work[key] = np.empty(shapes[key], dtype=f.dtype)
+  if out is None:
+    out = np.empty((ninterp**3, nelm), dtype=f.dtype, order='F')
+  if not out.flags.f_contiguous:
+    raise ValueError("out must be Fortran-ordered")
 
-  # then x
-  f_tmp2 = np.reshape(trans.dot(f_tmp), (ninterp, norder, ninterp,nelm), order='F')
-
-  # then y
-  f_p =     np.reshape(np.transpose(f_tmp2, (1,0,2,3)), (norder, ninterp**2*nelm), order='F')
-  f_trans = np.reshape(np.transpose(np.reshape(trans.dot(f_p), (ninterp, ninterp, ninterp, nelm), order='F'), (1,0,2,3)), (ninterp**3, nelm),        order='F')
+  tic()
+  # A Fortran-ordered (i,j,k,elm) block is a C-ordered (elm,k,j,i) one
+  f_c = np.reshape(np.asfortranarray(f).T, (nelm, norder, norder, norder))
+  out_c = np.reshape(out.T, (nelm, ninterp, ninterp**2))
+  for start in range(0, nelm, tile):
+    n = min(tile, nelm - start)
+    f_t = f_c[start:start+n]
+    w_x = work['x'][:n]
+    w_y = work['y'][:n]
+    # x: contract i as one matrix product over every (elm, k, j) row
+    np.matmul(np.reshape(f_t, (n*norder**2, norder)), trans.T, 
+              out=np.reshape(w_x, (n*norder**2, ninterp)))
+    # then y: contract j, batched over (elm, k)
+    np.matmul(trans, w_x, out=w_y)
+    # then z: contract k, batched over elm
+    np.matmul(trans, np.reshape(w_y, (n, norder, ninterp**2)), out=out_c[start:start+n])
   toc('trans')
 
-  #f_p = None; f_tmp2 = None; f_tmp = None; gc.collect()
-
-  return f_trans
+  return out
 
 from threading import Thread
 class TransformFieldElements(Thread):